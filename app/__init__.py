@@ -2,26 +2,24 @@
 
 import os
 import ast
-from io import StringIO
+import time
+import base64
+import hashlib
+from io import BytesIO
 
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, jsonify, g
 from flask_sqlalchemy import SQLAlchemy
-import sentry_sdk
-from sentry_sdk.integrations.flask import FlaskIntegration
-from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
 import numpy as np
-import pandas as pd
-from scipy.stats import beta
-import matplotlib as mpl
-
-mpl.use("Agg")
-import matplotlib.pyplot as plt
 
 # from facebook_business.api import FacebookAdsApi
 # from facebook_business.adobjects.ad import Ad
 
-from app.scripts import process as pro
+# Pandas (with scripts/process.py), SciPy, Matplotlib and Sentry are
+# imported where first needed to keep cold starts of the API fast
+from app.scripts import columns as col
 from app.scripts import bandit as ban
+from app import metrics as met
+from app.cache import TTLCache
 
 
 db = SQLAlchemy()
@@ -30,6 +28,31 @@ db = SQLAlchemy()
 CUTOFF = 14
 CUT_LEVEL = 0.5
 SHAPE = "linear"
+PLOT_CACHE_TTL = 300  # seconds a rendered form plot is reused
+PLOT_POINTS = 200  # points of the grid over the whole plotted range
+PLOT_POINTS_PER_OPTION = 41  # points within 10 std of each option's mean (odd)
+
+# Form plots (PNG data URIs) keyed by hash of the plotted bandit state;
+# plots are inlined into the result page, so any instance can serve it
+plots = TTLCache(ttl=PLOT_CACHE_TTL, maxsize=128)
+met.caches["plots"] = plots
+
+
+def plot_grid(means, stds):
+    """
+    Return plot range around the lowest and highest mean and its grid as
+    sorted union of a uniform grid and local grids within 10 standard
+    deviations of every mean, resolving narrow and wide densities alike
+    """
+    i_min = np.nanargmin(means)
+    i_max = np.nanargmax(means)
+    lower = max(means[i_min] - 10 * stds[i_min], 0)
+    upper = min(means[i_max] + 10 * stds[i_max], 1)
+    offsets = np.linspace(-10, 10, PLOT_POINTS_PER_OPTION)
+    local = means[:, None] + stds[:, None] * offsets
+    x = np.concatenate([np.linspace(lower, upper, PLOT_POINTS), local.ravel()])
+    x = np.unique(x[(x >= lower) & (x <= upper)])
+    return [x, lower, upper]
 
 
 def create_app(config_class: object):
@@ -39,6 +62,10 @@ def create_app(config_class: object):
         config_class: configuration for Flask app
     """
     if os.environ.get("FLASK_ENV") == "production":  # pragma: no cover
+        import sentry_sdk
+        from sentry_sdk.integrations.flask import FlaskIntegration
+        from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
+
         sentry_sdk.init(
             dsn="https://db6bdfc312434b7687d739a0c44ec603@sentry.io/1513206",
             integrations=[FlaskIntegration(), SqlalchemyIntegration()],
@@ -52,6 +79,32 @@ def create_app(config_class: object):
 
     app.register_blueprint(api_v1)
 
+    @app.before_request
+    def start_timing():
+        """Start timing the request and its pipeline stages."""
+        g.start = time.perf_counter()
+        g.timings = []
+
+    @app.after_request
+    def server_timing(response):
+        """
+        Add stage durations and total duration to the response
+        in a Server-Timing header and record the request latency
+        """
+        if "start" not in g:  # pragma: no cover
+            return response
+        seconds = time.perf_counter() - g.pop("start")
+        if request.endpoint is not None:
+            met.histogram(met.request_seconds, request.endpoint).observe(seconds)
+        timings = g.pop("timings", []) + [("total", seconds)]
+        response.headers["Server-Timing"] = met.server_timing(timings)
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        """Return latency histograms and cache counters in Prometheus format."""
+        return met.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
     @app.route("/ping", methods=["GET", "POST"])
     def ping():
         """Return string to show the server is alive."""
@@ -90,23 +143,32 @@ def create_app(config_class: object):
         for metric in request.json["optimize"]:
             weights[metric[:-1] + "_weight"] = None
 
-        data = pd.DataFrame(request.json["stats"])
-        data = pro.preprocess(data, **weights)
-        data = pro.filter_dates(data, cutoff=CUTOFF)
-        [options, data] = pro.reindex_options(data)
-
-        bandit = ban.Bandit(
-            num_options=len(options),
-            memory=True,
-            shape=SHAPE,
-            cutoff=CUTOFF,
-            cut_level=CUT_LEVEL,
-        )
-        bandit.add_daily_results(data)
-        shares = bandit.calculate_shares(accelerate=True)
-        options["ad_share"] = shares.tolist()
+        with met.timed("parse"):
+            columns = col.records_to_columns(request.json["stats"])
+        with met.timed("prepare"):
+            [options, option_ids, days_ago, trials, successes] = col.prepare(
+                columns, cutoff=CUTOFF, **weights
+            )
+
+        with met.timed("add_daily_results"):
+            bandit = ban.Bandit(
+                num_options=len(options),
+                memory=True,
+                shape=SHAPE,
+                cutoff=CUTOFF,
+                cut_level=CUT_LEVEL,
+            )
+            bandit.add_daily_arrays(option_ids, days_ago, trials, successes)
+        with met.timed("calculate_shares"):
+            shares = bandit.calculate_shares(accelerate=True)
 
-        return options.to_json(orient="records")
+        with met.timed("serialize"):
+            return jsonify(
+                [
+                    dict(option, ad_share=share)
+                    for option, share in zip(options, shares.tolist())
+                ]
+            )
 
     @app.route("/form", methods=["GET", "POST"])
     def form():
@@ -116,6 +178,8 @@ def create_app(config_class: object):
         """
 
         if request.method == "POST":
+            import pandas as pd
+
             entries = [value for value in list(request.form.values()) if value]
             num_options = int(len(entries) / 2)
             options = pd.DataFrame([{"option": str(i + 1)} for i in range(num_options)])
@@ -130,12 +194,11 @@ def create_app(config_class: object):
             options = format_results(options, shares)
             records = options.to_dict("records")
             columns = options.columns.values
-            save_plot(bandit)
             return render_template(
                 "form_result.html",
                 records=records,
                 columns=columns,
-                plot="/static/images/plot.png",
+                plot=render_plot(bandit),
             )
 
         return render_template("form.html")
@@ -150,6 +213,9 @@ def create_app(config_class: object):
         """
 
         if request.method == "POST":
+            import pandas as pd
+            from app.scripts import process as pro
+
             if request.form["update"] == "true":  # pragma: no cover
                 app_id = request.form["app_id"]
                 app_secret = request.form["app_secret"]
@@ -187,16 +253,17 @@ def create_app(config_class: object):
                 else:
                     weights[weight] = int(request.form[weight])
 
-            data = pd.read_csv(StringIO(request.form["ads"]), sep=None, engine="python")
-
             try:
-                data = pro.preprocess(
-                    data,
-                    weights["impression_weight"],
-                    weights["engagement_weight"],
-                    weights["click_weight"],
-                    weights["conversion_weight"],
-                )
+                with met.timed("parse"):
+                    data = pro.read_csv(request.form["ads"])
+                with met.timed("preprocess"):
+                    data = pro.preprocess(
+                        data,
+                        weights["impression_weight"],
+                        weights["engagement_weight"],
+                        weights["click_weight"],
+                        weights["conversion_weight"],
+                    )
             except Exception as error:  # pragma: no cover
                 print(error)
                 message = "Cannot pre-process your data. \
@@ -213,7 +280,8 @@ def create_app(config_class: object):
                 )
 
             try:
-                data = pro.filter_dates(data, cutoff=CUTOFF)
+                with met.timed("filter_dates"):
+                    data = pro.filter_dates(data, cutoff=CUTOFF)
             except Exception as error:  # pragma: no cover
                 print(error)
                 message = "Please check your dates (format should be YYYY-MM-DD)."
@@ -244,17 +312,20 @@ def create_app(config_class: object):
                     ads=request.form["ads"],
                 )
 
-            [options, data] = pro.reindex_options(data)
+            with met.timed("reindex_options"):
+                [options, data] = pro.reindex_options(data)
 
-            bandit = ban.Bandit(
-                num_options=len(options),
-                memory=True,
-                shape=SHAPE,
-                cutoff=CUTOFF,
-                cut_level=CUT_LEVEL,
-            )
-            bandit.add_daily_results(data)
-            shares = bandit.calculate_shares(accelerate=True)
+            with met.timed("add_daily_results"):
+                bandit = ban.Bandit(
+                    num_options=len(options),
+                    memory=True,
+                    shape=SHAPE,
+                    cutoff=CUTOFF,
+                    cut_level=CUT_LEVEL,
+                )
+                bandit.add_daily_results(data)
+            with met.timed("calculate_shares"):
+                shares = bandit.calculate_shares(accelerate=True)
 
             output = request.form["output"]
             if output == "status":
@@ -290,18 +361,6 @@ def create_app(config_class: object):
 
         return render_template("csv.html")
 
-    @app.after_request
-    def after_request(response):
-        """
-        Clear server cache after every request to display newest plot image
-        """
-        response.headers["Cache-Control"] = (
-            "no-cache, no-store, must-revalidate, public, max-age=0"
-        )
-        response.headers["Expires"] = 0
-        response.headers["Pragma"] = "no-cache"
-        return response
-
     def format_results(options, shares, status=False):
         """
         Return ACTIVE/PAUSED instead of numeric share for options if desired
@@ -317,36 +376,61 @@ def create_app(config_class: object):
             results["ad_share"] = results["ad_share"]
         return results
 
-    def save_plot(bandit):
+    def render_plot(bandit):
+        """
+        Render plot of bandit options' PDFs unless cached for the same
+        trials and successes; return it as PNG data URI to inline
         """
-        Save plot with bandit options' PDFs (beta distributions)
+        state = np.stack([bandit.trials, bandit.successes]).astype(np.int64)
+        key = hashlib.sha256(state.tobytes()).hexdigest()
+        plot = plots.get(key)
+        if plot is None:
+            png = base64.b64encode(plot_png(bandit)).decode()
+            plot = f"data:image/png;base64,{png}"
+            plots.set(key, plot)
+        return plot
+
+    def plot_png(bandit):
         """
-        x = np.linspace(0, 1, 100)
-        means = []
-        stds = []
-        for i in range(len(bandit.trials)):
-            a = bandit.successes[i]
-            b = bandit.trials[i] - bandit.successes[i]
-            means.append(beta.mean(a, b))
-            stds.append(beta.std(a, b))
-            plt.plot(x, beta.pdf(x, a, b), label="option " + str(i + 1))
-
-        i_min, min_mean = min(enumerate(means), key=lambda x: x[1])
-        i_max, max_mean = max(enumerate(means), key=lambda x: x[1])
-        plt.xlim(max(min_mean - 10 * stds[i_min], 0), min(max_mean + 10 * stds[i_max], 1))
-        plt.xlabel("Success rate")
-        plt.ylabel("Probablity density")
-        plt.grid()
-        plt.yticks([])
-        plt.legend()
-        plt.savefig("app/static/images/plot.png")
-        plt.clf()
+        Plot bandit options' PDFs (beta distributions) on a figure
+        of its own (no global pyplot state) and return it as PNG
+        """
+        from scipy.stats import beta
+        from matplotlib.figure import Figure
+
+        # Moments of all options' beta distributions at once
+        a = bandit.successes.astype(float)
+        b = (bandit.trials - bandit.successes).astype(float)
+        means = a / (a + b)
+        stds = np.sqrt(a * b / ((a + b) ** 2 * (a + b + 1)))
+
+        [x, lower, upper] = plot_grid(means, stds)
+        densities = beta.pdf(x, a[:, None], b[:, None])
+
+        figure = Figure()
+        axes = figure.subplots()
+        axes.plot(
+            x,
+            densities.T,
+            label=["option " + str(i + 1) for i in range(len(densities))],
+        )
+        axes.set_xlim(lower, upper)
+        axes.set_xlabel("Success rate")
+        axes.set_ylabel("Probablity density")
+        axes.grid()
+        axes.set_yticks([])
+        axes.legend()
+        buffer = BytesIO()
+        figure.savefig(buffer, format="png")
+        return buffer.getvalue()
 
     def update_facebook(app_id, app_secret, access_token, options):  # pragma: no cover
         """
         Update status of ads on Facebook if different from respective suggestion;
         return dataframe with updated ads
         """
+        import pandas as pd
+
         api = FacebookAdsApi.init(app_id, app_secret, access_token)
         updated = []
         # Determine number of required batches since
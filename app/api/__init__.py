@@ -1,11 +1,78 @@
 """Initialize API and provide decorators."""
 
+import atexit
+import datetime
+import time
 from functools import wraps
-from flask import request
+from threading import Lock, Thread
+
+from flask import request, g, current_app, Flask
+from sqlalchemy import update
+from sqlalchemy.exc import SQLAlchemyError
 
 from app import db
+from app.cache import TTLCache
+from app.metrics import caches
 from app.models.models import User
 
+AUTH_CACHE_TTL = 300  # seconds until API keys are looked up again
+ACTIVITY_FLUSH_INTERVAL = 60  # seconds between writes of users' last activity
+
+# API key -> user id
+user_ids = TTLCache(ttl=AUTH_CACHE_TTL, maxsize=10000)
+caches["api_keys"] = user_ids
+
+# User id -> last activity not yet written to the database
+activity = {}
+activity_lock = Lock()
+last_flush = time.monotonic()
+# App of the buffered activity, flushed once more when the process exits
+activity_app = None
+
+
+def flush_activity(app: Flask) -> None:
+    """Write buffered last activity times of users in one bulk update."""
+    with activity_lock:
+        pending = dict(activity)
+        activity.clear()
+    if not pending:
+        return
+    with app.app_context():
+        try:
+            db.session.execute(
+                update(User),
+                [
+                    {"id": user_id, "last_activity_at": activity_at}
+                    for user_id, activity_at in pending.items()
+                ],
+            )
+            db.session.commit()
+        except SQLAlchemyError:  # pragma: no cover
+            db.session.rollback()
+            app.logger.exception("Cannot write last activity of users")
+
+
+@atexit.register
+def flush_remaining_activity() -> None:
+    """Write activity buffered since the last flush, e.g. when traffic stopped."""
+    if activity_app is not None:
+        flush_activity(activity_app)
+
+
+def track_activity(user_id: int) -> None:
+    """Buffer user's last activity and flush buffer in background if due."""
+    global activity_app, last_flush
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    app = current_app._get_current_object()
+    with activity_lock:
+        activity[user_id] = now
+        activity_app = app
+        due = time.monotonic() - last_flush >= ACTIVITY_FLUSH_INTERVAL
+        if due:
+            last_flush = time.monotonic()
+    if due:
+        Thread(target=flush_activity, args=(app,), daemon=True).start()
+
 
 def require_auth(func):
     """Create decorator for authorization with API key."""
@@ -14,12 +81,21 @@ def require_auth(func):
     def func_wrapper(*args, **kwargs):
         if "API_KEY" not in request.headers:
             return "Credentials missing", 401
-        api_keys = [user[0] for user in User.query.with_entities(User.api_key).all()]
-        if request.headers["API_KEY"] not in api_keys:
-            return "Credentials not valid", 401
-        user = User.query.filter(User.api_key == request.headers["API_KEY"]).one()
-        user.last_activity_at = db.func.now()
-        db.session.commit()
+        api_key = request.headers["API_KEY"]
+        user_id = user_ids.get(api_key)
+        if user_id is None:
+            # Single row lookup on the unique (indexed) api_key column
+            user = (
+                User.query.with_entities(User.id)
+                .filter(User.api_key == api_key)
+                .one_or_none()
+            )
+            if user is None:
+                return "Credentials not valid", 401
+            user_id = user.id
+            user_ids.set(api_key, user_id)
+        track_activity(user_id)
+        g.user_id = user_id
         return func(*args, **kwargs)
 
     return func_wrapper
@@ -1,18 +1,39 @@
 """Endpoints for API v1."""
 
-from typing import List, Dict
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import random
+from typing import List, Dict, Tuple, Union
 
-from flask import request, abort
-from flask_restx import Api, Resource, fields
-import pandas as pd
+from flask import request, abort, g, Response
+from flask_restx import Api, Resource, fields, marshal
+import numpy as np
 
+from app import db
 from app.api import require_auth
+from app.cache import TTLCache
+from app.metrics import caches, timed
 from app.api.v1 import api_v1
-from app.scripts import process as pro
+from app.scripts import columns as col
 from app.scripts import bandit as ban
+from app.scripts import batch as bat
+from app.models.models import CampaignState
 
-pd.set_option("display.max_columns", 10)
-pd.set_option("display.max_rows", 200)
+CUTOFF = 14  # days of stats taken into account
+SHAPE = "linear"  # discount shape of past days
+CUT_LEVEL = 0.5  # weight of stats at cutoff distance
+HALF_LIFE = 7  # days after which stored campaign statistics count half
+RESULT_CACHE_TTL = 600  # seconds to reuse shares of identical requests
+LOG_SAMPLE_RATE = 0.01  # share of requests whose input and result are logged
+
+# Shares keyed by hash of the inputs they are (deterministically) computed from
+results = TTLCache(ttl=RESULT_CACHE_TTL, maxsize=256)
+caches["ads_results"] = results
+
+logger = logging.getLogger(__name__)
 
 api = Api(
     api_v1,
@@ -58,54 +79,495 @@ ads_response = api.model(
     },
 )
 
+campaign = api.model(
+    "campaign",
+    {
+        "campaign_id": fields.String(required=True),
+        "stats": fields.List(fields.Nested(stats), required=True),
+    },
+)
+
+ads_batch_request = api.model(
+    "Ads Batch Request",
+    {
+        "optimize": fields.List(
+            fields.String,
+            required=True,
+            description="any combination of 'impressions', 'engagements', "
+            "'clicks' and 'conversions'",
+        ),
+        "campaigns": fields.List(fields.Nested(campaign), required=True),
+    },
+)
+
+
+def optimize_weights(optimize: List[str]) -> Dict:
+    """Return preprocess weights with inferred weights for optimized metrics."""
+    weights = {
+        "impression_weight": 0,
+        "engagement_weight": 0,
+        "click_weight": 0,
+        "conversion_weight": 0,
+    }
+    for metric in optimize:
+        weights[metric[:-1] + "_weight"] = None
+    return weights
+
+
+def log_sampled(message: str, *args) -> None:
+    """Log debug message for a sample of requests, formatted only if emitted."""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE:
+        logger.debug(message, *args)
+
+
+def query_optimize() -> List[str]:
+    """Return optimize metrics from comma separated query parameter."""
+    optimize = [
+        metric
+        for value in request.args.getlist("optimize")
+        for metric in value.split(",")
+        if metric
+    ]
+    if not optimize or not set(optimize) <= set(col.METRICS[1:]):
+        abort(400, '"optimize" query parameter is empty or invalid')
+    return optimize
+
+
+def read_binary_columns() -> Dict:
+    """Return stats columns from binary columnar request body."""
+    format = col.FORMATS.get(request.mimetype)
+    if format is None:
+        abort(415, f"Content type {request.mimetype} is not supported")
+    try:
+        return col.read_columns(request.get_data(), format)
+    except ImportError:  # pragma: no cover
+        abort(415, f"Content type {request.mimetype} is not supported on this server")
+    except (ValueError, OSError) as error:
+        abort(400, f"Cannot read stats: {error}")
+
+
+def result_key(optimize: List[str], format: str, stats: bytes) -> str:
+    """
+    Return SHA-256 hex digest of the canonical inputs of ad shares: optimize
+    metrics, stats format and content, bandit parameters and today's date.
+    """
+    parameters = {
+        "optimize": sorted(set(optimize)),
+        "format": format,
+        "cutoff": CUTOFF,
+        "shape": SHAPE,
+        "cut_level": CUT_LEVEL,
+        "date": datetime.date.today().isoformat(),
+    }
+    digest = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode())
+    digest.update(stats)
+    return digest.hexdigest()
+
+
+def respond(
+    options: List[Dict], shares: List[float], headers: Dict = None
+) -> Union[Response, Tuple]:
+    """
+    Return ad shares as JSON records (default) or, if accepted by the client,
+    in a compact columnar format serialized without per-record marshalling.
+    """
+    headers = dict(headers or {}, Vary="Accept")
+    mimetype = request.accept_mimetypes.best_match(
+        ["application/json"] + list(col.RESULT_FORMATS), default="application/json"
+    )
+    with timed("serialize"):
+        if mimetype == "application/json":
+            records = [
+                dict(option, ad_share=share) for option, share in zip(options, shares)
+            ]
+            return marshal(records, ads_response), 200, headers
+        columns = {
+            key: [
+                None if option.get(key) is None else str(option[key])
+                for option in options
+            ]
+            for key in col.KEYS
+        }
+        columns["ad_share"] = np.asarray(shares, dtype=float)
+        try:
+            data = col.write_columns(columns, col.RESULT_FORMATS[mimetype])
+        except ImportError:  # pragma: no cover
+            abort(406, f"Content type {mimetype} is not supported on this server")
+    return Response(data, headers=headers, mimetype=mimetype)
+
+
+def build_bandit(columns: Dict, weights: Dict) -> List:
+    """Return options and Bandit loaded with the daily results from stats columns."""
+    with timed("prepare"):
+        [options, option_ids, days_ago, trials, successes] = col.prepare(
+            columns, cutoff=CUTOFF, **weights
+        )
+
+    with timed("add_daily_results"):
+        bandit = ban.Bandit(
+            num_options=len(options),
+            memory=True,
+            shape=SHAPE,
+            cutoff=CUTOFF,
+            cut_level=CUT_LEVEL,
+        )
+        bandit.add_daily_arrays(option_ids, days_ago, trials, successes)
+    return [options, bandit]
+
+
+def update_state(
+    state: CampaignState,
+    options: List[Dict],
+    option_ids: np.ndarray,
+    days_ago: np.ndarray,
+    trials: np.ndarray,
+    successes: np.ndarray,
+) -> List[str]:
+    """
+    Decay stored campaign statistics to the latest day of the new results
+    and add these (equally decayed) daily results to them; new results for
+    the stored latest day replace its stored (undecayed) results of the
+    posted options, days before it cannot be changed anymore and are
+    returned as skipped dates. Metric weights are inferred per post, so
+    stored days can be weighted differently unless all posts cover
+    comparable stats (e.g. whole days of all ads).
+    """
+    today = datetime.date.today()
+    new = days_ago >= 0
+    skipped = []
+    if state.date is not None:
+        stored_days_ago = (today - state.date).days
+        old = new & (days_ago > stored_days_ago)
+        skipped = sorted(
+            {str(today - datetime.timedelta(days=int(day))) for day in days_ago[old]}
+        )
+        new &= ~old
+    if not new.any():
+        return skipped
+    option_ids = option_ids[new]
+    days_ago = days_ago[new]
+    trials = trials[new]
+    successes = successes[new]
+
+    # Map options to stored options, appending new ones
+    stored_options = list(state.options)
+    positions = {
+        tuple(sorted(option.items())): i for i, option in enumerate(stored_options)
+    }
+    state_ids = np.zeros(shape=(len(options),), dtype=int)
+    for option_id in np.unique(option_ids):
+        key = tuple(sorted(options[option_id].items()))
+        if key not in positions:
+            positions[key] = len(stored_options)
+            stored_options.append(options[option_id])
+        state_ids[option_id] = positions[key]
+    option_ids = state_ids[option_ids]
+
+    padding = [0.0] * (len(stored_options) - len(state.options))
+    stored_trials = np.array(state.trials + padding, dtype=float)
+    stored_successes = np.array(state.successes + padding, dtype=float)
+    # Undecayed results of the stored latest day per option
+    padding = [0.0] * (len(stored_options) - len(state.latest_trials))
+    latest_trials = np.array(state.latest_trials + padding, dtype=float)
+    latest_successes = np.array(state.latest_successes + padding, dtype=float)
+    if state.date is not None:
+        # Replace stored latest day's results of the posted options only
+        # (e.g. intraday updates), keeping those of other options
+        replaced = np.unique(option_ids[days_ago == stored_days_ago])
+        stored_trials[replaced] -= latest_trials[replaced]
+        stored_successes[replaced] -= latest_successes[replaced]
+        stored_trials = np.maximum(stored_trials, 0)
+        stored_successes = np.maximum(stored_successes, 0)
+        latest_trials[replaced] = 0
+        latest_successes[replaced] = 0
+    latest = days_ago.min()
+    date = today - datetime.timedelta(days=int(latest))
+    if state.date is not None:
+        stored_trials = ban.decay(stored_trials, (date - state.date).days, HALF_LIFE)
+        stored_successes = ban.decay(
+            stored_successes, (date - state.date).days, HALF_LIFE
+        )
+    np.add.at(
+        stored_trials, option_ids, ban.decay(trials, days_ago - latest, HALF_LIFE)
+    )
+    np.add.at(
+        stored_successes,
+        option_ids,
+        ban.decay(successes, days_ago - latest, HALF_LIFE),
+    )
+
+    # Keep latest day's results to be replaced by later posts of that day
+    on_latest = days_ago == latest
+    if state.date is None or date != state.date:
+        latest_trials[:] = 0
+        latest_successes[:] = 0
+    np.add.at(latest_trials, option_ids[on_latest], trials[on_latest])
+    np.add.at(latest_successes, option_ids[on_latest], successes[on_latest])
+
+    state.options = stored_options
+    state.trials = stored_trials.tolist()
+    state.successes = stored_successes.tolist()
+    state.latest_trials = latest_trials.tolist()
+    state.latest_successes = latest_successes.tolist()
+    state.date = date
+    return skipped
+
 
 @ads.route("")
 class Ads(Resource):
+    def validate_payload(self, func):
+        """Validate JSON payloads only, binary payloads are read as columns."""
+        if request.is_json:
+            with timed("validate"):
+                super().validate_payload(func)
+
     @require_auth
     @api.doc(
-        responses={200: "Success", 400: "Bad Request", 401: "Unauthorized"},
-        params={"API_KEY": {"in": "header"}},
+        description="Post stats as JSON or as binary columns with the stats model's "
+        "fields (content type " + ", ".join(col.FORMATS) + ") and "
+        "the optimize metrics as comma separated query parameter.",
+        responses={
+            400: "Bad Request",
+            401: "Unauthorized",
+            415: "Unsupported Media Type",
+        },
+        params={
+            "API_KEY": {"in": "header"},
+            "optimize": {"in": "query", "description": "for binary stats only"},
+        },
     )
+    @api.response(200, "Success", [ads_response])
+    @api.produces(["application/json"] + list(col.RESULT_FORMATS))
     @api.expect(ads_request, validate=True)
-    @api.marshal_list_with(ads_response)
     def post(self) -> List[Dict]:
         """Get optimal next period budget shares for ad options."""
+        if request.is_json:
+            if not request.json["optimize"]:  # pragma: no cover
+                if not request.json["stats"]:
+                    abort(400, '"optimize" and "stats" keys are empty')
+                abort(400, '"optimize" key is empty')
+            if not request.json["stats"]:  # pragma: no cover
+                abort(400, '"stats" key is empty')
+            optimize = request.json["optimize"]
+            format = "json"
+            stats = json.dumps(
+                request.json["stats"], sort_keys=True, separators=(",", ":")
+            ).encode()
+        else:
+            optimize = query_optimize()
+            format = request.mimetype
+            stats = request.get_data()
+
+        # Identical requests of the same day get the same (seeded) shares
+        with timed("cache"):
+            key = result_key(optimize, format, stats)
+            result = results.get(key)
+        if result is not None:
+            return respond(*result, headers={"X-Cache": "HIT"})
+
+        with timed("parse"):
+            if request.is_json:
+                columns = col.records_to_columns(request.json["stats"])
+            else:
+                columns = read_binary_columns()
+
+        weights = optimize_weights(optimize)
+        log_sampled("input optimize: %s", optimize)
+
+        try:
+            [options, bandit] = build_bandit(columns, weights)
+        except ValueError as error:
+            abort(400, f"Cannot read stats: {error}")
+        with timed("calculate_shares"):
+            shares = bandit.calculate_shares(accelerate=True, seed=int(key[:16], 16))
+        shares = shares.tolist()
+        log_sampled("ad shares (result): %s", shares)
+
+        results.set(key, (options, shares))
+        return respond(options, shares, headers={"X-Cache": "MISS"})
+
+
+@ads.route("/cache")
+class AdsCache(Resource):
+    @require_auth
+    @api.doc(
+        responses={200: "Success", 401: "Unauthorized"},
+        params={"API_KEY": {"in": "header"}},
+    )
+    def get(self) -> Dict[str, int]:
+        """Get size and hit and miss counts of the ad shares cache."""
+        return results.stats()
+
+
+@ads.route("/stream")
+class AdsStream(Resource):
+    @require_auth
+    @api.doc(
+        description="Post stats records as newline-delimited JSON (content type "
+        "application/x-ndjson, optionally with gzip content encoding) and the "
+        "optimize metrics as comma separated query parameter; records are summed "
+        "per ad and day while the body is read.",
+        responses={
+            400: "Bad Request",
+            401: "Unauthorized",
+            415: "Unsupported Media Type",
+        },
+        params={"API_KEY": {"in": "header"}, "optimize": {"in": "query"}},
+    )
+    @api.response(200, "Success", [ads_response])
+    @api.produces(["application/json"] + list(col.RESULT_FORMATS))
+    def post(self) -> List[Dict]:
+        """Get optimal next period budget shares for streamed ad stats."""
+        optimize = query_optimize()
+        if request.mimetype != "application/x-ndjson":
+            abort(415, f"Content type {request.mimetype} is not supported")
+        stream = request.stream
+        if request.content_encoding == "gzip":
+            stream = gzip.GzipFile(fileobj=stream)
+        elif request.content_encoding not in [None, "identity"]:
+            abort(415, f"Content encoding {request.content_encoding} is not supported")
+
+        with timed("parse"):
+            try:
+                columns = col.fold_records(
+                    json.loads(line) for line in stream if line.strip()
+                )
+            except (ValueError, OSError, EOFError) as error:
+                abort(400, f"Cannot read stats: {error}")
+
+        weights = optimize_weights(optimize)
+        try:
+            [options, bandit] = build_bandit(columns, weights)
+        except ValueError as error:
+            abort(400, f"Cannot read stats: {error}")
+        if not options:
+            abort(400, f"No stats from the past {CUTOFF} days")
+        with timed("calculate_shares"):
+            shares = bandit.calculate_shares(accelerate=True)
+        return respond(options, shares.tolist())
+
+
+@ads.route("/batch")
+class AdsBatch(Resource):
+    @require_auth
+    @api.doc(
+        responses={200: "Success", 400: "Bad Request", 401: "Unauthorized"},
+        params={"API_KEY": {"in": "header"}},
+    )
+    @api.expect(ads_batch_request, validate=True)
+    def post(self) -> Dict[str, List[Dict]]:
+        """Get optimal next period budget shares for ads of multiple campaigns."""
         if not request.json["optimize"]:  # pragma: no cover
-            if not request.json["stats"]:
-                abort(400, '"optimize" and "stats" keys are empty')
             abort(400, '"optimize" key is empty')
-        if not request.json["stats"]:  # pragma: no cover
-            abort(400, '"stats" key is empty')
-
-        weights = {
-            "impression_weight": 0,
-            "engagement_weight": 0,
-            "click_weight": 0,
-            "conversion_weight": 0,
-        }
-        for metric in request.json["optimize"]:
-            weights[metric[:-1] + "_weight"] = None
+        if not request.json["campaigns"]:  # pragma: no cover
+            abort(400, '"campaigns" key is empty')
+
+        weights = optimize_weights(request.json["optimize"])
+        campaign_ids = []
+        campaign_options = []
+        bandits = []
+        for campaign in request.json["campaigns"]:
+            if campaign["campaign_id"] in campaign_ids:
+                abort(400, f'"campaign_id" {campaign["campaign_id"]} is not unique')
+            if not campaign["stats"]:  # pragma: no cover
+                abort(400, f'"stats" of campaign {campaign["campaign_id"]} are empty')
+            columns = col.records_to_columns(campaign["stats"])
+            try:
+                [options, bandit] = build_bandit(columns, weights)
+            except ValueError as error:
+                abort(
+                    400,
+                    f'Cannot read stats of campaign {campaign["campaign_id"]}: {error}',
+                )
+            campaign_ids.append(campaign["campaign_id"])
+            campaign_options.append(options)
+            bandits.append(bandit)
+
+        # Sample all campaigns' shares in one pass
+        with timed("calculate_shares"):
+            campaign_shares = bat.calculate_shares(bandits, accelerate=True)
+
+        results = {}
+        with timed("serialize"):
+            for campaign_id, options, shares in zip(
+                campaign_ids, campaign_options, campaign_shares
+            ):
+                results[campaign_id] = marshal(
+                    [
+                        dict(option, ad_share=share)
+                        for option, share in zip(options, shares.tolist())
+                    ],
+                    ads_response,
+                )
+        return results
 
-        data = pd.DataFrame(request.json["stats"])
-        print(f"\n----------\n\ninput data:\n{data}")
-        print(f"\ninput optimize:\n{request.json['optimize']}")
 
-        data = pro.preprocess(data, **weights)
-        print(f"\nprocessed data:\n{data}")
+@ads.route("/campaigns/<string:campaign_id>")
+@ads.param("campaign_id", "Your identifier of the campaign")
+class CampaignAds(Resource):
+    @require_auth
+    @api.doc(
+        description="Stats of a day already stored replace that day's stored "
+        "stats of the posted ads; days before the latest stored day are skipped "
+        "and listed in the X-Skipped-Dates header. Weights of the optimize "
+        "metrics are inferred from each post's stats, so posts should cover "
+        "comparable stats, e.g. whole days of all ads.",
+        responses={400: "Bad Request", 401: "Unauthorized"},
+        params={"API_KEY": {"in": "header"}},
+    )
+    @api.response(200, "Success", [ads_response])
+    @api.produces(["application/json"] + list(col.RESULT_FORMATS))
+    @api.expect(ads_request, validate=True)
+    def post(self, campaign_id: str) -> List[Dict]:
+        """
+        Add new stats (e.g. only the latest day) to the stored campaign
+        statistics and get optimal next period budget shares for its ad options.
+        """
+        if not request.json["optimize"]:  # pragma: no cover
+            abort(400, '"optimize" key is empty')
+
+        state = CampaignState.query.filter_by(
+            user_id=g.user_id, campaign_id=campaign_id
+        ).one_or_none()
+        if state is None:
+            state = CampaignState(
+                user_id=g.user_id,
+                campaign_id=campaign_id,
+                options=[],
+                trials=[],
+                successes=[],
+                latest_trials=[],
+                latest_successes=[],
+            )
+
+        skipped = []
+        if request.json["stats"]:
+            weights = optimize_weights(request.json["optimize"])
+            with timed("prepare"):
+                columns = col.records_to_columns(request.json["stats"])
+                try:
+                    prepared = col.prepare(columns, cutoff=CUTOFF, **weights)
+                except ValueError as error:
+                    abort(400, f"Cannot read stats: {error}")
+            skipped = update_state(state, *prepared)
 
-        data = pro.filter_dates(data, cutoff=14)
-        [options, data] = pro.reindex_options(data)
+        if not state.options:  # pragma: no cover
+            abort(400, f"No stats from the past {CUTOFF} days")
+        db.session.add(state)
+        db.session.commit()
 
         bandit = ban.Bandit(
-            num_options=len(options),
+            num_options=len(state.options),
             memory=True,
-            shape="linear",
-            cutoff=14,
-            cut_level=0.5,
+            shape="exponential",
+            half_life=HALF_LIFE,
         )
-        bandit.add_daily_results(data)
-        shares = bandit.calculate_shares(accelerate=True)
-        options["ad_share"] = shares.tolist()
-        print(f"\nad shares (result):\n{options}")
-
-        return options.to_dict(orient="records")
+        bandit.decayed_trials[:] = state.trials
+        bandit.decayed_successes[:] = state.successes
+        with timed("calculate_shares"):
+            shares = bandit.calculate_shares(accelerate=True)
+        headers = {}
+        if skipped:
+            # Days before the stored latest day are not added again
+            headers["X-Skipped-Dates"] = ",".join(skipped)
+        return respond(state.options, shares.tolist(), headers=headers)
@@ -0,0 +1,95 @@
+"""Request stage timings and latency histograms."""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Iterator, List
+
+from flask import g, has_request_context
+
+from app.cache import TTLCache
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Thread-safe cumulative histogram of observed latencies."""
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds: float) -> None:
+        """Count latency in the first bucket whose upper bound it does not exceed."""
+        with self._lock:
+            self.counts[bisect_left(self.buckets, seconds)] += 1
+            self.sum += seconds
+
+    def lines(self, name: str, labels: str) -> List[str]:
+        """Return histogram in Prometheus text exposition format."""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {total}")
+        lines.append(f"{name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+# Histograms per pipeline stage and per endpoint
+stage_seconds: Dict[str, Histogram] = {}
+request_seconds: Dict[str, Histogram] = {}
+histograms_lock = Lock()
+
+# Caches whose hit and miss counts are exported
+caches: Dict[str, TTLCache] = {}
+
+
+def histogram(histograms: Dict[str, Histogram], name: str) -> Histogram:
+    """Return histogram of name, creating it on first use."""
+    if name not in histograms:
+        with histograms_lock:
+            histograms.setdefault(name, Histogram())
+    return histograms[name]
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Time the block as pipeline stage of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        histogram(stage_seconds, stage).observe(seconds)
+        if has_request_context():
+            g.setdefault("timings", []).append((stage, seconds))
+
+
+def server_timing(timings: List[tuple]) -> str:
+    """Return Server-Timing header value with stage durations in milliseconds."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings)
+
+
+def render() -> str:
+    """Return all histograms and cache counters in Prometheus text format."""
+    lines = ["# TYPE stage_seconds histogram"]
+    for stage, stage_histogram in sorted(stage_seconds.items()):
+        lines += stage_histogram.lines("stage_seconds", f'stage="{stage}"')
+    lines.append("# TYPE request_seconds histogram")
+    for endpoint, request_histogram in sorted(request_seconds.items()):
+        lines += request_histogram.lines("request_seconds", f'endpoint="{endpoint}"')
+    for counter in ["hits", "misses"]:
+        lines.append(f"# TYPE cache_{counter}_total counter")
+        for name, cache in sorted(caches.items()):
+            count = cache.stats()[counter]
+            lines.append(f'cache_{counter}_total{{cache="{name}"}} {count}')
+    return "\n".join(lines) + "\n"
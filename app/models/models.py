@@ -27,3 +27,18 @@ class User(BaseModel):
     name = db.Column(db.String, nullable=False)
     api_key = db.Column(db.String, unique=True, nullable=False)
     last_activity_at = db.Column(db.DateTime)
+
+
+class CampaignState(BaseModel):
+    """Decayed posterior statistics per option of one user's campaign."""
+
+    __table_args__ = (db.UniqueConstraint("user_id", "campaign_id"),)
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    campaign_id = db.Column(db.String, nullable=False)
+    options = db.Column(db.JSON, nullable=False)  # option key columns
+    trials = db.Column(db.JSON, nullable=False)  # decayed trials per option
+    successes = db.Column(db.JSON, nullable=False)  # decayed successes per option
+    latest_trials = db.Column(db.JSON, nullable=False)  # trials of date per option
+    latest_successes = db.Column(db.JSON, nullable=False)  # successes of date
+    date = db.Column(db.Date, nullable=False)  # last date included
@@ -1,7 +1,99 @@
 import datetime
+import functools
 import math
 import numpy as np
-from scipy.stats import beta
+
+
+@functools.lru_cache(maxsize=32)
+def discount_kernel(shape, cutoff, cut_level):
+    """
+    Return period weights indexed by distance from now for the
+    alternatively shaped discount functions (read-only, cached)
+    """
+    distance = np.arange(cutoff, dtype=float)
+    if shape == "constant":  # pragma: no cover
+        # Equal weight for every period
+        weights = np.ones(shape=(cutoff,), dtype=float)
+    elif shape == "linear":
+        # Weight linearly decreases with distance
+        weights = 1 - distance / cutoff * (1 - cut_level)
+    elif shape == "degressive":  # pragma: no cover
+        # Weight decrease (slope) shrinks with distance
+        weights = 1 - (1 - cut_level) / cutoff ** (1 / 2) * distance ** (1 / 2)
+    elif shape == "progressive":  # pragma: no cover
+        # Weight decrease (slope) grows over distance
+        weights = 1 - (1 - cut_level) / cutoff**2 * distance**2
+    else:  # pragma: no cover
+        raise ValueError(f"Unknown discount shape: {shape}")
+    weights.setflags(write=False)
+    return weights
+
+
+def decay(values, days, half_life):
+    """
+    Exponentially discount values that are days old with given half-life
+    """
+    return values * 0.5 ** (np.asarray(days) / half_life)
+
+
+def top_options(sampled_theta, choices):
+    """
+    Return indices of the choices largest samples in every row (unordered)
+    using partial selection instead of a full sort
+    """
+    return np.argpartition(-sampled_theta, choices - 1, axis=-1)[..., :choices]
+
+
+def sampling_plan(num_options, accelerate):
+    """
+    Return number of options chosen per repetition and number of
+    repetitions for estimating shares of num_options options by sampling;
+    accelerate chooses more options in fewer repetitions
+    """
+    if accelerate:
+        choices = max(math.ceil(num_options / 10), 1)
+        repetitions = 10
+        # choices = int(np.sqrt(num_options))
+        # repetitions = math.ceil(num_options / choices)
+    else:
+        choices = 1
+        repetitions = 100
+    return [choices, repetitions]
+
+
+def integration_grid(a, b, lower, upper, grid_size=64, max_points=4096, tail=1e-9):
+    """
+    Return sorted grid between lower and upper for integrating over the
+    Beta(a, b) distributions with at most 2 * max_points + 2 points:
+    up to max_points of their pooled quantiles (evenly spaced in standard
+    normal scores) refined with grid_size points within the tail bounds of
+    each distribution too narrow for it (those with the largest means first)
+    """
+    from scipy.special import ndtr, ndtri
+    from scipy.stats import beta
+
+    bound = -ndtri(tail)
+    # Quantiles per distribution, fewer with many distributions
+    quantiles = max(8, min(grid_size, max_points // len(a)))
+    levels = ndtr(np.linspace(-bound, bound, quantiles))
+    x = beta.ppf(levels, a[:, None], b[:, None]).ravel()
+    x = np.sort(x[(x > lower) & (x < upper)])
+    if len(x) > max_points:
+        # Keep evenly spaced ranks, dense where the quantiles are dense
+        x = x[np.linspace(0, len(x) - 1, max_points).astype(int)]
+    x = np.unique(np.concatenate([[lower, upper], x]))
+
+    # Refine around distributions with less than 2 grid points per std
+    means = a / (a + b)
+    stds = np.sqrt(a * b / ((a + b) ** 2 * (a + b + 1)))
+    positions = np.searchsorted(x, means).clip(1, len(x) - 1)
+    narrow = np.flatnonzero(x[positions] - x[positions - 1] > stds / 2)
+    narrow = narrow[np.argsort(-means[narrow])][: max_points // grid_size]
+    local = means[narrow, None] + stds[narrow, None] * np.linspace(
+        -bound, bound, grid_size
+    )
+    local = local[(local > lower) & (local < upper)]
+    return np.unique(np.concatenate([x, local]))
 
 
 class Bandit:
@@ -12,7 +104,13 @@ class Bandit:
     """
 
     def __init__(
-        self, num_options, memory=True, shape="linear", cutoff=28, cut_level=0.5
+        self,
+        num_options,
+        memory=True,
+        shape="linear",
+        cutoff=28,
+        cut_level=0.5,
+        half_life=None,
     ):
         self.memory = memory
         self.num_options = num_options
@@ -20,17 +118,88 @@ class Bandit:
         self.trials = np.zeros(shape=(self.num_options,), dtype=int)
         self.successes = np.zeros(shape=(self.num_options,), dtype=int)
         if self.memory:
-            self.periods = {"trials": [], "successes": []}
             self.shape = shape
             self.cutoff = cutoff
             self.cut_level = cut_level
+            self.num_periods = 0
+            if self.shape == "exponential":
+                # Running sums decayed once per period, no history is kept;
+                # by default weights reach cut_level for results cutoff days
+                # ago (finite kernels weigh the latest period at distance 1
+                # and reach it one day earlier, but never decay to zero)
+                if half_life is None and not 0 < self.cut_level <= 1:
+                    raise ValueError(
+                        "Exponential shape needs 0 < cut_level <= 1 or a half_life, "
+                        f"got cut_level {self.cut_level}"
+                    )
+                if half_life is None and self.cut_level == 1:
+                    half_life = math.inf  # no decay
+                elif half_life is None:
+                    half_life = self.cutoff * math.log(0.5) / math.log(self.cut_level)
+                self.half_life = half_life
+                self.decayed_trials = np.zeros(shape=(self.num_options,), dtype=float)
+                self.decayed_successes = np.zeros(
+                    shape=(self.num_options,), dtype=float
+                )
+                return
+            # Ring buffer with the results of the last cutoff + 1 periods,
+            # older periods have zero weight and are overwritten
+            self.period_trials = np.zeros(
+                shape=(self.cutoff + 1, self.num_options), dtype=int
+            )
+            self.period_successes = np.zeros(
+                shape=(self.cutoff + 1, self.num_options), dtype=int
+            )
+
+    def check_ring_buffer(self):
+        """
+        Raise ValueError if the Bandit keeps no periods, i.e. has no memory
+        or only running sums of the exponential shape
+        """
+        if not self.memory or self.shape == "exponential":
+            raise ValueError("Periods are only kept for memory with finite shapes")
+
+    @property
+    def current_slot(self):
+        """
+        Ring buffer row of the current (last added) period;
+        the exponential shape keeps no ring buffer
+        """
+        self.check_ring_buffer()
+        return (self.num_periods - 1) % len(self.period_trials)
+
+    def period_slots(self, num_periods):
+        """
+        Return ring buffer rows of the last num_periods periods (oldest first)
+        """
+        return np.arange(self.num_periods - num_periods, self.num_periods) % len(
+            self.period_trials
+        )
+
+    @property
+    def periods(self):
+        """
+        Memorized periods still held in the ring buffer (oldest first);
+        the exponential shape keeps no ring buffer
+        """
+        self.check_ring_buffer()
+        slots = self.period_slots(min(self.num_periods, len(self.period_trials)))
+        return {
+            "trials": list(self.period_trials[slots]),
+            "successes": list(self.period_successes[slots]),
+        }
 
     def add_period(self):
         """
-        Add new empty period to memory
+        Add new empty period to memory, replacing the oldest one if full
         """
-        self.periods["trials"].append(np.zeros(shape=(self.num_options,), dtype=int))
-        self.periods["successes"].append(np.zeros(shape=(self.num_options,), dtype=int))
+        self.num_periods += 1
+        if self.shape == "exponential":
+            self.decayed_trials = decay(self.decayed_trials, 1, self.half_life)
+            self.decayed_successes = decay(self.decayed_successes, 1, self.half_life)
+            return
+        self.period_trials[self.current_slot] = 0
+        self.period_successes[self.current_slot] = 0
 
     def add_results(self, option_id, trials, successes):
         """
@@ -38,115 +207,221 @@ class Bandit:
         """
         self.trials[option_id] += trials
         self.successes[option_id] += successes
-        if self.memory:
-            self.periods["trials"][-1][option_id] += trials
-            self.periods["successes"][-1][option_id] += successes
+        if self.memory and self.shape == "exponential":
+            self.decayed_trials[option_id] += trials
+            self.decayed_successes[option_id] += successes
+        elif self.memory:
+            self.period_trials[self.current_slot, option_id] += trials
+            self.period_successes[self.current_slot, option_id] += successes
 
     def add_daily_results(self, data):
         """
         For each day, add a period with its option results to the Bandit
         """
-        for i in range(self.cutoff + 1):
-            self.add_period()
-            daily_results = data.loc[
-                data["date"]
-                == datetime.date.today() - datetime.timedelta(days=self.cutoff - i)
-            ]
-            for j in range(len(daily_results)):
-                self.add_results(
-                    int(daily_results.iloc[j]["option_id"]),
-                    daily_results.iloc[j]["trials"],
-                    daily_results.iloc[j]["successes"],
+        today = np.datetime64(datetime.date.today(), "D")
+        days_ago = (today - data["date"].to_numpy(dtype="datetime64[D]")).astype(int)
+        self.add_daily_arrays(
+            data["option_id"].to_numpy(dtype=int),
+            days_ago,
+            data["trials"].to_numpy(),
+            data["successes"].to_numpy(),
+        )
+
+    def add_daily_arrays(self, option_ids, days_ago, trials, successes):
+        """
+        Add a period for each of the last cutoff + 1 days and scatter
+        the results given as arrays (option id, days before today,
+        trials and successes per row) into them in one operation
+        """
+        in_range = (days_ago >= 0) & (days_ago <= self.cutoff)
+        option_ids = option_ids[in_range]
+        days_ago = days_ago[in_range]
+        trials = trials[in_range]
+        successes = successes[in_range]
+        self.num_periods += self.cutoff + 1
+        if self.shape == "exponential":
+            # Decay running sums by the added periods, results by their age
+            for attribute, values in [
+                ("decayed_trials", trials),
+                ("decayed_successes", successes),
+            ]:
+                decayed = decay(
+                    getattr(self, attribute), self.cutoff + 1, self.half_life
                 )
+                np.add.at(decayed, option_ids, decay(values, days_ago, self.half_life))
+                setattr(self, attribute, decayed)
+        # Truncate like item assignment into the integer arrays
+        trials = trials.astype(int)
+        successes = successes.astype(int)
+        if self.shape != "exponential":
+            # Adding cutoff + 1 periods replaces the whole ring buffer
+            self.period_trials[:] = 0
+            self.period_successes[:] = 0
+            slots = (self.num_periods - 1 - days_ago) % len(self.period_trials)
+            np.add.at(self.period_trials, (slots, option_ids), trials)
+            np.add.at(self.period_successes, (slots, option_ids), successes)
+        np.add.at(self.trials, option_ids, trials)
+        np.add.at(self.successes, option_ids, successes)
 
     def weigh_options(self):
         """
         Weigh options for current period's choice based on distance from now
         with alternatively shaped discount functions
         """
-        # Initialize trial and success weights for each option
-        trial_weights = np.zeros(shape=(self.num_options,), dtype=float)
-        success_weights = np.zeros(shape=(self.num_options,), dtype=float)
-        num_periods = len(self.periods["trials"])
-        # Loop over each period and option and
-        # determine and add respective weights
-        for period_id in range(num_periods):
-            distance = num_periods - period_id
-            for option_id in range(self.num_options):
-                trials = self.periods["trials"][period_id][option_id]
-                successes = self.periods["successes"][period_id][option_id]
-                if distance < self.cutoff:
-                    if self.shape == "constant":  # pragma: no cover
-                        # Equal weight for every period
-                        weight = 1
-                    elif self.shape == "linear":
-                        # Weight linearly decreases with distance
-                        weight = 1 - distance / self.cutoff * (1 - self.cut_level)
-                    elif self.shape == "degressive":  # pragma: no cover
-                        # Weight decrease (slope) shrinks with distance
-                        weight = 1 - (1 - self.cut_level) / self.cutoff ** (
-                            1 / 2
-                        ) * distance ** (1 / 2)
-                    elif self.shape == "progressive":  # pragma: no cover
-                        # Weight decrease (slope) grows over distance
-                        weight = 1 - (1 - self.cut_level) / self.cutoff**2 * distance**2
-                    trial_weights[option_id] += trials * weight
-                    success_weights[option_id] += successes * weight
+        if self.shape == "exponential":
+            return [self.decayed_trials.copy(), self.decayed_successes.copy()]
+        # Only periods closer than cutoff carry weight
+        num_periods = min(self.num_periods, self.cutoff - 1)
+        if num_periods <= 0:
+            return [
+                np.zeros(shape=(self.num_options,), dtype=float),
+                np.zeros(shape=(self.num_options,), dtype=float),
+            ]
+        # Look up weights of recent periods by distance and
+        # reduce the ring buffer matrices with them
+        kernel = discount_kernel(self.shape, self.cutoff, self.cut_level)
+        weights = np.zeros(shape=(len(self.period_trials),), dtype=float)
+        weights[self.period_slots(num_periods)] = kernel[np.arange(num_periods, 0, -1)]
+        trial_weights = weights @ self.period_trials
+        success_weights = weights @ self.period_successes
         return [trial_weights, success_weights]
 
+    def get_weights(self):
+        """
+        Return trial and success weights for options, discounted if Bandit
+        has memory, else cumulated trials and successes
+        """
+        if self.memory:
+            return self.weigh_options()
+        return [self.trials, self.successes]
+
+    def draw_samples(self, repetitions, random=None):
+        """
+        Draw one sample from each option's Beta distribution per repetition
+        in a single batched call; return repetitions x options array
+        """
+        if random is None:
+            random = np.random
+        trial_weights, success_weights = self.get_weights()
+        return random.beta(
+            self.prior[0] + success_weights,
+            self.prior[1] + trial_weights - success_weights,
+            size=(repetitions, self.num_options),
+        )
+
     def choose_options(self, choices):
         """
         Create Beta distributions for each option, draw one sample each,
         choose the specified number of options with the largest values
         """
-        # Calculate trials and success weighs for options if Bandit has memory,
-        # else use cumulated trials and successes
-        if self.memory:
-            trial_weights, success_weights = self.weigh_options()
-        else:
-            trial_weights, success_weights = self.trials, self.successes
-        sampled_theta = []
-        for i in range(self.num_options):
-            # Construct beta distribution for each option's success
-            dist = beta(
-                self.prior[0] + success_weights[i],
-                self.prior[1] + trial_weights[i] - success_weights[i],
-            )
-            # Draw one sample from beta distribution
-            sampled_theta += [dist.rvs()]
+        sampled_theta = self.draw_samples(repetitions=1)
         # Return the indices of the samples with the largest values
-        return [
-            idx
-            for (idx, theta) in sorted(enumerate(sampled_theta), key=lambda x: x[1])[
-                -choices:
-            ]
-        ]
+        return top_options(sampled_theta, choices)[0].tolist()
 
-    def repeat_choice(self, choices, repetitions):
+    def repeat_choice(self, choices, repetitions, random=None):
         """
         Repeat choosing process and return aggregate outcome
         """
-        # Initialize option_counts array with zeros
+        sampled_theta = self.draw_samples(repetitions=repetitions, random=random)
+        winners = top_options(sampled_theta, choices)
+        return np.bincount(winners.ravel(), minlength=self.num_options)
+
+    def estimate_shares(
+        self, choices, precision, batch_size=50, max_repetitions=10000, random=None
+    ):
+        """
+        Repeat choosing in batches until the standard error of every
+        option's share is at most precision (or max_repetitions is reached);
+        return shares and number of repetitions used
+        """
         option_counts = np.zeros(shape=(self.num_options,), dtype=int)
-        # Choose best options and increment respective counts
-        for _ in range(repetitions):
-            options = self.choose_options(choices=choices)
-            for option in options:
-                option_counts[option] += 1
-        return option_counts
+        repetitions = 0
+        while repetitions < max_repetitions:
+            batch = min(batch_size, max_repetitions - repetitions)
+            option_counts += self.repeat_choice(choices, batch, random=random)
+            repetitions += batch
+            # Each option is picked per repetition with probability p,
+            # smoothed to not stop early on options never picked yet
+            p = (option_counts + 0.5) / (repetitions + 1)
+            errors = np.sqrt(p * (1 - p) / repetitions) / choices
+            if errors.max() <= precision:
+                break
+        shares = option_counts / (choices * repetitions)
+        return [shares, repetitions]
 
-    def calculate_shares(self, accelerate):
+    def best_probabilities(
+        self, grid_size=64, max_points=4096, tail=1e-9, chunk_size=2**20
+    ):
+        """
+        Calculate each option's exact probability of having the largest
+        success rate by integrating its Beta density times the other options'
+        Beta CDFs over a bounded grid of the candidates' pooled quantiles,
+        refined around narrow distributions (see integration_grid);
+        deterministic, no sampling
+        """
+        # SciPy is only imported for exact mode to keep app start-up fast
+        from scipy.integrate import trapezoid
+        from scipy.special import betainc
+        from scipy.stats import beta
+
+        trial_weights, success_weights = self.get_weights()
+        a = self.prior[0] + success_weights
+        b = self.prior[1] + trial_weights - success_weights
+        # Below the largest lower tail bound some option is almost surely
+        # better, options entirely below it cannot be best
+        upper_bounds = beta.ppf(1 - tail, a, b)
+        lower = beta.ppf(tail, a, b).max()
+        candidates = upper_bounds > lower
+        x = integration_grid(
+            a[candidates],
+            b[candidates],
+            lower,
+            upper_bounds.max(),
+            grid_size=grid_size,
+            max_points=max_points,
+            tail=tail,
+        )
+        a = a[candidates, None]
+        b = b[candidates, None]
+
+        # Integrate in chunks of grid points (overlapping by one point)
+        # to bound memory with many candidates
+        probabilities = np.zeros(shape=(len(a),), dtype=float)
+        step = max(chunk_size // len(a), 2)
+        for start in range(0, len(x) - 1, step):
+            chunk = x[start : start + step + 1]
+            # Regularized incomplete beta function is the Beta CDF
+            log_cdfs = np.log(np.maximum(betainc(a, b, chunk), 1e-300))
+            densities = beta.pdf(chunk, a, b)
+            # Product of all other candidates' CDFs via sum of logs minus own
+            others = np.exp(log_cdfs.sum(axis=0) - log_cdfs)
+            probabilities += trapezoid(densities * others, chunk, axis=1)
+        shares = np.zeros(shape=(self.num_options,), dtype=float)
+        shares[candidates] = probabilities
+        # Normalize to absorb integration error
+        return shares / shares.sum()
+
+    def calculate_shares(self, accelerate, exact=False, precision=None, seed=None):
         """
         Choose best options at current state,
-        return each option's suggested share for the next period
-        """
-        if accelerate:
-            choices = math.ceil(self.num_options / 10)
-            repetitions = 10
-            # choices = int(np.sqrt(self.num_options))
-            # repetitions = math.ceil(self.num_options / choices)
-        else:
-            choices = 1
-            repetitions = 100
-        shares = self.repeat_choice(choices, repetitions) / (choices * repetitions)
+        return each option's suggested share for the next period;
+        exact uses the probabilities of being best instead of sampling,
+        precision samples until shares converge to that standard error,
+        seed makes sampling reproducible; number of repetitions used
+        is kept in the repetitions attribute
+        """
+        if exact:
+            self.repetitions = 0
+            return self.best_probabilities()
+        random = None if seed is None else np.random.default_rng(seed)
+        [choices, repetitions] = sampling_plan(self.num_options, accelerate)
+        if precision is not None:
+            shares, self.repetitions = self.estimate_shares(
+                choices, precision, random=random
+            )
+            return shares
+        self.repetitions = repetitions
+        shares = self.repeat_choice(choices, repetitions, random=random) / (
+            choices * repetitions
+        )
         return shares
@@ -0,0 +1,36 @@
+import numpy as np
+
+from app.scripts import bandit as ban
+
+
+def calculate_shares(bandits, accelerate, random=None):
+    """
+    Choose best options for multiple Bandits at once by sampling all
+    repetitions of the Bandits with the same number of options in a single
+    pass over their (unpadded) campaigns x options array; return each
+    Bandit's option shares with the same semantics as Bandit.calculate_shares
+    """
+    if random is None:
+        random = np.random
+    widths = np.array([bandit.num_options for bandit in bandits], dtype=int)
+    shares = [np.zeros(shape=(width,), dtype=float) for width in widths]
+    # Bucket campaigns by number of options, so that no samples are padding
+    for width in np.unique(widths[widths > 0]):
+        members = np.flatnonzero(widths == width)
+        weights = [bandits[i].get_weights() for i in members]
+        alphas = np.array(
+            [bandits[i].prior[0] + w[1] for i, w in zip(members, weights)]
+        )
+        betas = np.array(
+            [bandits[i].prior[1] + w[0] - w[1] for i, w in zip(members, weights)]
+        )
+        [choices, repetitions] = ban.sampling_plan(width, accelerate)
+        sampled_theta = random.beta(alphas, betas, size=(repetitions,) + alphas.shape)
+        # Count each campaign's winners in its own block of option counts
+        winners = ban.top_options(sampled_theta, choices)
+        winners += (np.arange(len(members)) * width)[None, :, None]
+        option_counts = np.bincount(winners.ravel(), minlength=len(members) * width)
+        option_counts = option_counts.reshape(len(members), width)
+        for i, counts in zip(members, option_counts):
+            shares[i] = counts / (choices * repetitions)
+    return shares
@@ -0,0 +1,270 @@
+import datetime
+import json
+from io import BytesIO
+import numpy as np
+
+KEYS = ["channel", "ad_id"]
+METRICS = ["cost", "impressions", "engagements", "clicks", "conversions"]
+
+# Content types of binary columnar stats formats
+FORMATS = {
+    "application/x-npz": "npz",
+    "application/vnd.apache.arrow.stream": "arrow",
+    "application/vnd.apache.parquet": "parquet",
+}
+
+# Content types of columnar result formats
+RESULT_FORMATS = {
+    "application/x-columns+json": "json",
+    "application/x-npz": "npz",
+    "application/vnd.apache.arrow.stream": "arrow",
+}
+
+
+def records_to_columns(records):
+    """
+    Transpose stats records (dicts with channel (optional), date, ad_id,
+    cost, impressions, engagements, clicks and conversions) into column lists
+    """
+    columns = {column: [] for column in KEYS + ["date"] + METRICS}
+    for record in records:
+        for column, values in columns.items():
+            values.append(record.get(column))
+    return columns
+
+
+def fold_records(records):
+    """
+    Sum the metrics of stats records per option (channel and ad_id) and date
+    while iterating them, skipping records without ad_id, date or cost;
+    return columns with the number of summed records in a rows column
+    """
+    positions = {}
+    keys = []
+    sums = []
+    for record in records:
+        if not isinstance(record, dict):
+            raise ValueError("Stats records must be objects")
+        if record.get("ad_id") is None or record.get("date") is None:
+            continue
+        values = [
+            0.0 if record.get(metric) in [None, ""] else float(record[metric])
+            for metric in METRICS
+        ]
+        if values[0] == 0:
+            continue
+        key = (record.get("channel"), record["ad_id"], record["date"])
+        position = positions.get(key)
+        if position is None:
+            positions[key] = len(keys)
+            keys.append(key)
+            sums.append(values + [1.0])
+        else:
+            total = sums[position]
+            for i, value in enumerate(values):
+                total[i] += value
+            total[-1] += 1.0
+    sums = np.array(sums, dtype=float).reshape(len(sums), len(METRICS) + 1)
+    columns = {
+        column: [key[i] for key in keys] for i, column in enumerate(KEYS + ["date"])
+    }
+    for i, column in enumerate(METRICS + ["rows"]):
+        columns[column] = sums[:, i]
+    return columns
+
+
+def read_columns(data, format):
+    """
+    Read binary columnar stats (NumPy npz, Arrow IPC stream or Parquet)
+    with the columns of stats records into a dict of arrays;
+    Arrow and Parquet require the optional pyarrow package
+    """
+    if format == "npz":
+        with np.load(BytesIO(data), allow_pickle=False) as arrays:
+            columns = {name: arrays[name] for name in arrays.files}
+    elif format in ["arrow", "parquet"]:
+        import pyarrow
+
+        if format == "arrow":
+            table = pyarrow.ipc.open_stream(data).read_all()
+        else:
+            import pyarrow.parquet
+
+            table = pyarrow.parquet.read_table(pyarrow.BufferReader(data))
+        columns = {
+            name: table.column(name).to_numpy(zero_copy_only=False)
+            for name in table.column_names
+        }
+    else:  # pragma: no cover
+        raise ValueError(f"Unknown stats format: {format}")
+    for column in ["date", "ad_id"]:
+        if column not in columns:
+            raise ValueError(f"Stats column {column} missing")
+    lengths = {name: len(values) for name, values in columns.items()}
+    if len(set(lengths.values())) > 1:
+        raise ValueError(f"Stats columns differ in length: {lengths}")
+    return columns
+
+
+def write_columns(columns, format):
+    """
+    Write a dict of equally long column lists or arrays as column-oriented
+    JSON (missing values as null), compressed NumPy npz (missing strings as
+    empty strings) or Arrow IPC stream (requires the optional pyarrow package)
+    """
+    if format == "json":
+        return json.dumps(
+            {
+                name: values.tolist() if isinstance(values, np.ndarray) else values
+                for name, values in columns.items()
+            },
+            separators=(",", ":"),
+        ).encode()
+    if format == "npz":
+        buffer = BytesIO()
+        np.savez_compressed(
+            buffer,
+            **{
+                name: (
+                    values
+                    if isinstance(values, np.ndarray)
+                    else np.array(["" if value is None else value for value in values])
+                )
+                for name, values in columns.items()
+            },
+        )
+        return buffer.getvalue()
+    if format == "arrow":
+        import pyarrow
+
+        table = pyarrow.table(
+            {name: pyarrow.array(values) for name, values in columns.items()}
+        )
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    raise ValueError(f"Unknown result format: {format}")  # pragma: no cover
+
+
+def is_plain(values):
+    """Return whether values are an array without missing (None) entries"""
+    return isinstance(values, np.ndarray) and values.dtype.kind in "biufUS"
+
+
+def to_floats(values):
+    """Return float array with missing and empty values set to 0"""
+    if not (isinstance(values, np.ndarray) and values.dtype.kind in "biuf"):
+        values = [0.0 if value is None or value == "" else value for value in values]
+    return np.nan_to_num(np.asarray(values, dtype=float), nan=0.0)
+
+
+def factorize(values):
+    """
+    Return codes numbering the unique values of an array in order
+    of appearance and the positions of their first appearances
+    """
+    first, inverse = np.unique(values, return_index=True, return_inverse=True)[1:]
+    order = np.argsort(first)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return [ranks[inverse.ravel()], first[order]]
+
+
+def prepare(
+    columns,
+    cutoff,
+    impression_weight=None,
+    engagement_weight=None,
+    click_weight=None,
+    conversion_weight=None,
+):
+    """
+    Prepare stats columns for bandit optimization without a dataframe,
+    equivalent to process.preprocess, filter_dates and reindex_options
+    (including an optional rows column with the number of raw rows summed);
+    return options (key dicts) and arrays with option id, days before today,
+    trials and successes per option and date
+    """
+    # Drop rows with missing required entries
+    dates = np.array(columns["date"], dtype="datetime64[D]")
+    valid = ~np.isnat(dates)
+    if not is_plain(columns["ad_id"]):
+        valid &= np.array([ad_id is not None for ad_id in columns["ad_id"]])
+
+    # Collect metrics as rows x metrics array, remove rows with 0 cost
+    values = np.zeros(shape=(len(dates), len(METRICS)), dtype=float)
+    for i, metric in enumerate(METRICS):
+        if metric in columns:
+            values[:, i] = to_floats(columns[metric])
+    valid &= values[:, 0] != 0
+    values = values[valid]
+
+    # If not provided, set weights to respective cost ratios
+    totals = values.sum(axis=0)
+    weights = np.array(
+        [impression_weight, engagement_weight, click_weight, conversion_weight]
+    )
+    for i, weight in enumerate(weights):
+        if weight is None:
+            weights[i] = 0 if totals[i + 1] == 0 else totals[0] / totals[i + 1]
+    weights = weights.astype(float)
+
+    # Successes as weighted sum of success metrics, trials as
+    # costs + successes + 1 (per raw row) to guarantee successes <= trials
+    successes = values[:, 1:] @ weights
+    raw_rows = to_floats(columns["rows"])[valid] if "rows" in columns else 1
+    trials = np.trunc(values[:, 0]) + successes + raw_rows
+
+    # Keep rows in cutoff range
+    today = np.datetime64(datetime.date.today(), "D")
+    days_ago = (today - dates[valid]).astype(int)
+    recent = days_ago <= cutoff
+    rows = np.flatnonzero(valid)[recent]
+
+    # Number options (unique key combinations) in order of appearance
+    keys = [
+        key
+        for key in KEYS
+        if key in columns and any(value is not None for value in columns[key])
+    ]
+    if all(is_plain(columns[key]) for key in keys):
+        # Combine codes of each key column and factorize the combinations
+        key_values = [np.asarray(columns[key])[rows] for key in keys]
+        codes = np.zeros(shape=(len(rows),), dtype=int)
+        for values in key_values:
+            key_codes = factorize(values)[0]
+            codes = codes * (key_codes.max(initial=-1) + 1) + key_codes
+        [option_ids, first] = factorize(codes)
+        options = [
+            dict(zip(keys, option))
+            for option in zip(*[values[first].tolist() for values in key_values])
+        ]
+    else:
+        positions = {}
+        options = []
+        option_ids = np.zeros(shape=(len(rows),), dtype=int)
+        for i, row in enumerate(rows):
+            option = tuple(columns[key][row] for key in keys)
+            if option not in positions:
+                positions[option] = len(options)
+                options.append(dict(zip(keys, option)))
+            option_ids[i] = positions[option]
+
+    # Collapse rows of the same option and date (e.g. placement or hourly
+    # breakdowns) into one by summing their trials and successes, so that
+    # they are truncated to whole numbers after summing like in preprocess
+    days_ago = days_ago[recent]
+    first_day = days_ago.min(initial=0)
+    num_days = days_ago.max(initial=0) - first_day + 1
+    [groups, inverse] = np.unique(
+        option_ids * num_days + days_ago - first_day, return_inverse=True
+    )
+    inverse = inverse.ravel()
+    return [
+        options,
+        groups // num_days,
+        groups % num_days + first_day,
+        np.bincount(inverse, weights=trials[recent], minlength=len(groups)),
+        np.bincount(inverse, weights=successes[recent], minlength=len(groups)),
+    ]
@@ -1,7 +1,191 @@
+import csv
 import datetime
+from io import BytesIO
 import numpy as np
 import pandas as pd
 
+from app.scripts import columns as col
+
+# Export profiles mapping standardized export column names to model columns;
+# a profile applies to exports with its date, ad_id and cost columns,
+# other columns (e.g. ad_name) describe options unless in DROP_COLUMNS
+PROFILES = {
+    "facebook": {
+        "channel": "channel",
+        "reporting_ends": "date",
+        "ad_id": "ad_id",
+        "amount_spent_(eur)": "cost",
+        "impressions": "impressions",
+        "post_engagement": "engagements",
+        "link_clicks": "clicks",
+        "purchases": "conversions",
+    },
+    "google": {
+        "channel": "channel",
+        "day": "date",
+        "ad_id": "ad_id",
+        "cost": "cost",
+        "impressions": "impressions",
+        "engagements": "engagements",
+        "clicks": "clicks",
+        "conversions": "conversions",
+    },
+    "api": {column: column for column in col.KEYS + ["date"] + col.METRICS},
+}
+
+# Compact dtypes of model columns when read with a profile
+DTYPES = {
+    "channel": "category",
+    "date": "category",
+    "ad_id": "category",
+    "cost": "float32",
+    "impressions": "float32",
+    "engagements": "float32",
+    "clicks": "float32",
+    "conversions": "float32",
+}
+
+COLUMN_NAMES = {
+    name: column for profile in PROFILES.values() for name, column in profile.items()
+}
+DROP_COLUMNS = ["reporting_starts", "currency"]
+
+CSV_SAMPLE_SIZE = 65536  # characters to detect the delimiter from
+CSV_CHUNK_SIZE = 100000  # rows per chunk when reading large exports
+
+
+def detect_delimiter(text):
+    """Return delimiter of CSV text detected from a sample of its first lines"""
+    sample = text[:CSV_SAMPLE_SIZE]
+    if len(text) > CSV_SAMPLE_SIZE and "\n" in sample:
+        sample = sample[: sample.rfind("\n")]
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:  # pragma: no cover
+        return ","
+
+
+def standardize(column):
+    """Return column name in standardized input format"""
+    return column.lower().replace(" ", "_")
+
+
+def detect_profile(columns):
+    """Return name of the export profile matching the columns or None"""
+    columns = {standardize(column) for column in columns}
+    for name, profile in PROFILES.items():
+        if all(
+            column in columns
+            for column, model in profile.items()
+            if model in ["date", "ad_id", "cost"]
+        ):
+            return name
+    return None
+
+
+def standardize_columns(data):
+    """
+    Standardize column name input format, rename columns from
+    Facebook and Google exports and drop their unused columns
+    """
+    data.columns = [
+        COLUMN_NAMES.get(standardize(column), standardize(column))
+        for column in data.columns
+    ]
+    return data.drop(
+        [column for column in DROP_COLUMNS if column in data.columns], axis="columns"
+    )
+
+
+def aggregate(data):
+    """
+    Sum metrics, truncated costs and number of rows of running ads
+    per option (e.g. channel and ad_id) and date
+    """
+    data = standardize_columns(data)
+    if "cost" in data.columns:
+        data = data.loc[pd.to_numeric(data["cost"]).fillna(0) != 0]
+    if "rows" not in data.columns:
+        # Trials count whole cost units per raw row, independent of chunking
+        data = data.assign(rows=1)
+        if "cost" in data.columns:
+            data = data.assign(
+                truncated_cost=np.trunc(pd.to_numeric(data["cost"]).fillna(0))
+            )
+    sums = [
+        column
+        for column in col.METRICS + ["truncated_cost", "rows"]
+        if column in data.columns
+    ]
+    keys = [column for column in data.columns if column not in sums]
+    # Sum compact metric dtypes with full precision
+    data = data.astype({column: float for column in sums if column != "rows"})
+    return data.groupby(keys, sort=False, dropna=False, observed=True, as_index=False)[
+        sums
+    ].sum()
+
+
+def coerce_metrics(data):
+    """
+    Convert metric columns to compact floats with non-numeric
+    entries (e.g. "--" for empty metrics) as missing values
+    """
+    return data.assign(
+        **{
+            column: pd.to_numeric(data[column], errors="coerce").astype(DTYPES[column])
+            for column in col.METRICS
+            if column in data.columns
+        }
+    )
+
+
+def read_csv(text, chunksize=CSV_CHUNK_SIZE):
+    """
+    Parse CSV text with the C engine and the delimiter detected from a sample;
+    with a matching export profile, columns are read with standardized names
+    and compact dtypes (descriptive columns as categoricals, non-numeric
+    metrics as missing values) and unused columns are skipped;
+    exports with more than chunksize rows are read chunk by chunk and
+    aggregated per option and date as they arrive to bound memory
+    """
+    delimiter = detect_delimiter(text)
+    end = text.find("\n")
+    header = next(csv.reader([text if end == -1 else text[:end]], delimiter=delimiter))
+    profile = PROFILES.get(detect_profile(header))
+    if profile is None:  # pragma: no cover
+        usecols, dtype, names = None, None, None
+    else:
+        usecols = [
+            column for column in header if standardize(column) not in DROP_COLUMNS
+        ]
+        names = {
+            column: profile.get(standardize(column), standardize(column))
+            for column in usecols
+        }
+        # Metrics are converted after parsing to tolerate placeholders
+        dtype = {
+            column: DTYPES.get(names[column], "category")
+            for column in usecols
+            if names[column] not in col.METRICS
+        }
+    # Encoded bytes take a quarter of the memory of a (UCS4) StringIO copy
+    chunks = pd.read_csv(
+        BytesIO(text.encode()),
+        sep=delimiter,
+        usecols=usecols,
+        dtype=dtype,
+        chunksize=chunksize,
+    )
+    if names is not None:
+        chunks = (coerce_metrics(chunk.rename(columns=names)) for chunk in chunks)
+    data = next(chunks)
+    aggregated = None
+    for chunk in chunks:
+        if aggregated is None:
+            aggregated = aggregate(data)
+        aggregated = aggregate(pd.concat([aggregated, aggregate(chunk)]))
+    return data if aggregated is None else aggregated
+
 
 def preprocess(
     data,
@@ -16,71 +200,60 @@ def preprocess(
     for bandit optimization
     """
 
-    # Standardize column name input format
-    data.columns = [column.lower().replace(" ", "_") for column in data.columns]
-
-    # Rename columns from Facebook export
-    data.rename(columns={"reporting_ends": "date"}, inplace=True)
-    data.rename(columns={"amount_spent_(eur)": "cost"}, inplace=True)
-    data.rename(columns={"post_engagement": "engagements"}, inplace=True)
-    data.rename(columns={"link_clicks": "clicks"}, inplace=True)
-    data.rename(columns={"purchases": "conversions"}, inplace=True)
-    if "reporting_starts" in data.columns:  # pragma: no cover
-        data.drop(["reporting_starts"], axis="columns", inplace=True)
-
-    # Rename columns from Google export
-    data.rename(columns={"day": "date"}, inplace=True)
-    if "currency" in data.columns:  # pragma: no cover
-        data.drop(["currency"], axis="columns", inplace=True)
+    data = standardize_columns(data)
 
     # Drop rows with missing required entries
-    data.dropna(axis="index", inplace=True, subset=["ad_id", "date"])
+    data = data.dropna(axis="index", subset=["ad_id", "date"])
 
-    # Set relevant empty and NaN values to 0 for calculations
-    data = data.replace("", np.nan)
-    for column in ["cost", "impressions", "engagements", "clicks", "conversions"]:
+    # Collect metrics as rows x metrics array with empty and NaN values set to 0
+    values = np.zeros(shape=(len(data), len(col.METRICS)), dtype=float)
+    for i, column in enumerate(col.METRICS):
         if column in data.columns:
-            # data[column] = data[column].fillna(value=0.0, downcast='infer')
-            data[column] = data[column].fillna(value=0.0)
-        else:  # pragma: no cover
-            data[column] = 0.0
+            values[:, i] = (
+                pd.to_numeric(data[column].replace("", np.nan)).fillna(0.0).to_numpy()
+            )
+    data = data.drop([c for c in col.METRICS if c in data.columns], axis="columns")
+
+    # Number of raw rows and sum of their truncated costs if data
+    # has been aggregated
+    if "rows" in data.columns:
+        rows = data.pop("rows").to_numpy(dtype=float)
+    else:
+        rows = np.ones(shape=(len(data),), dtype=float)
+    if "truncated_cost" in data.columns:
+        truncated_cost = data.pop("truncated_cost").to_numpy(dtype=float)
+    else:
+        truncated_cost = np.trunc(values[:, 0])
 
     # Remove rows with 0 cost (ads that did not run)
-    data = data[data["cost"] != 0]
+    running = values[:, 0] != 0
+    data = data.loc[running]
+    values = values[running]
+    rows = rows[running]
+    truncated_cost = truncated_cost[running]
 
     # If not provided, set weights to respective cost ratios
-    weights = {}
-    for weight in ["impression", "engagement", "click", "conversion"]:
-        if locals()[weight + "_weight"] is None:
-            if data[weight + "s"].sum() == 0:  # pragma: no cover
-                weights[weight + "_weight"] = 0
-            else:
-                weights[weight + "_weight"] = (
-                    data["cost"].sum() / data[weight + "s"].sum()
-                )
-        else:
-            weights[weight + "_weight"] = locals()[weight + "_weight"]
-
-    # Create successes column as weighted sum of success metrics
-    data["successes"] = [
-        row["impressions"] * weights["impression_weight"]
-        + row["engagements"] * weights["engagement_weight"]
-        + row["clicks"] * weights["click_weight"]
-        + row["conversions"] * weights["conversion_weight"]
-        for index, row in data.iterrows()
-    ]
+    totals = values.sum(axis=0)
+    weights = np.array(
+        [impression_weight, engagement_weight, click_weight, conversion_weight]
+    )
+    for i, weight in enumerate(weights):
+        if weight is None:
+            weights[i] = 0 if totals[i + 1] == 0 else totals[0] / totals[i + 1]
+    weights = weights.astype(float)
 
-    # Create trials column as costs + successes + 1
+    # Create successes column as weighted sum of success metrics;
+    # create trials column as costs + successes + 1 (per raw row)
     # to guarantee successes <= trials and correct for free impressions
-    data["trials"] = [
-        int(row["cost"]) + row["successes"] + 1 for index, row in data.iterrows()
-    ]
+    successes = values[:, 1:] @ weights
+    data = data.assign(successes=successes, trials=truncated_cost + successes + rows)
 
-    # Drop processed columns
-    drop = ["cost", "impressions", "engagements", "clicks", "conversions"]
-    data.drop(drop, axis="columns", inplace=True)
-
-    return data.reset_index(drop=True)
+    # Collapse rows of the same option and date (e.g. placement or hourly
+    # breakdowns) into one by summing their successes and trials
+    keys = [column for column in data.columns if column not in ["successes", "trials"]]
+    return data.groupby(keys, sort=False, dropna=False, observed=True, as_index=False)[
+        ["successes", "trials"]
+    ].sum()
 
 
 def filter_dates(data, cutoff):
@@ -97,10 +270,17 @@ def reindex_options(data):
     Process dataframe with ad_id, date, trials and successes;
     return options and dataframe with option id column
     """
-    combinations = data.drop(["date", "trials", "successes"], axis="columns")
-    options = combinations.drop_duplicates().reset_index().drop("index", axis="columns")
-    data["option_id"] = 0
-    for i in range(len(data)):
-        option_id = options.loc[options["ad_id"] == data.iloc[i]["ad_id"]].index[0]
-        data.at[i, "option_id"] = option_id
+    # Options are the unique combinations of all other columns
+    # (e.g. channel and ad_id), numbered in order of appearance
+    keys = [
+        column
+        for column in data.columns
+        if column not in ["date", "trials", "successes"]
+    ]
+    option_ids = data.groupby(keys, sort=False, dropna=False, observed=True).ngroup()
+    # Return options with plain (not categorical) columns
+    options = (
+        data.loc[~option_ids.duplicated(), keys].astype(object).reset_index(drop=True)
+    )
+    data = data.assign(option_id=option_ids.to_numpy())
     return [options, data]
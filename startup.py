@@ -0,0 +1,51 @@
+"""Report import time of the app per module to catch slow cold starts."""
+
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+# Creating the app (with all routes) as on a cold start
+STATEMENT = "from app import config, create_app; create_app(config.TestingConfig)"
+
+BUDGET = float(os.environ.get("IMPORT_TIME_BUDGET", 1.5))  # seconds
+# Subsystems that must be imported by the routes needing them only
+LAZY_MODULES = ["pandas", "scipy", "matplotlib", "sentry_sdk"]
+
+
+def import_times(statement: str = STATEMENT) -> List[Tuple[str, float, float]]:
+    """Return name, self and cumulative import seconds of statement's modules."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        times.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+    return times
+
+
+def main(top: int = 20) -> int:
+    """Print slowest imports and return 1 if over budget or not lazy enough."""
+    times = import_times()
+    total = sum(own for _, own, _ in times)
+    print(f"{'module':<50} {'self [ms]':>10} {'cumulative [ms]':>16}")
+    for name, own, cumulative in sorted(times, key=lambda x: x[2], reverse=True)[:top]:
+        print(f"{name:<50} {own * 1000:>10.1f} {cumulative * 1000:>16.1f}")
+    print(f"\ntotal: {total:.3f} s (budget {BUDGET:.3f} s)")
+
+    imported = {name.split(".")[0] for name, _, _ in times}
+    eager = [module for module in LAZY_MODULES if module in imported]
+    if eager:
+        print(f"imported on start-up: {', '.join(eager)}")
+    return 1 if eager or total > BUDGET else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
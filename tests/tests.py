@@ -1,12 +1,28 @@
 """Unit tests."""
 
 import os
+import io
+import gzip
+import base64
+import json
 import datetime
+import time
 import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
 
 from app.config import TestingConfig
-from app import create_app, db
-from app.models.models import User
+from app import create_app, db, plot_grid, plots
+from app.models.models import User, CampaignState
+from app.api import activity, user_ids, flush_activity, flush_remaining_activity
+from app.api.v1.routes import results
+from app.scripts import bandit as ban
+from app.scripts import batch as bat
+from app.scripts import process as pro
+from app.scripts import columns as col
+import startup
 
 
 class TestSetup(unittest.TestCase):
@@ -38,6 +54,14 @@ class TestBasic(TestSetup):
         assert response.status_code == 200
 
 
+class TestStartup(unittest.TestCase):
+    """Test app start-up imports."""
+
+    def test_lazy_imports(self):
+        modules = {name.split(".")[0] for name, _, _ in startup.import_times()}
+        assert not modules & set(startup.LAZY_MODULES)
+
+
 class TestApp(TestSetup):
     """Test app factory."""
 
@@ -81,6 +105,42 @@ class TestApp(TestSetup):
         assert b"option" in response.data
         assert b"ad_share" in response.data
 
+        # Plot is inlined as PNG data URI, reused for the same results
+        plot = response.text.split('<img src="')[1].split('"')[0]
+        assert plot.startswith("data:image/png;base64,")
+        assert base64.b64decode(plot.split(",")[1]).startswith(b"\x89PNG")
+        misses = plots.stats()["misses"]
+        response = self.app.test_client().post(
+            "/form",
+            data={
+                "trials_1": 1000,
+                "successes_1": 100,
+                "trials_2": 1000,
+                "successes_2": 50,
+            },
+        )
+        assert plot in response.text
+        assert plots.stats()["misses"] == misses
+
+    def test_plot_grid(self):
+        from scipy.stats import beta
+
+        # Narrow densities next to wide ones
+        for trials, successes in [
+            [[100000, 20, 30], [1000, 2, 3]],
+            [[10000, 10], [100, 5]],
+        ]:
+            a = np.array(successes, dtype=float)
+            b = np.array(trials, dtype=float) - a
+            means = a / (a + b)
+            stds = np.sqrt(a * b / ((a + b) ** 2 * (a + b + 1)))
+            [x, lower, upper] = plot_grid(means, stds)
+            assert (np.diff(x) > 0).all() and x[0] == lower and x[-1] == upper
+            # Drawn peaks reach the densities at the modes
+            peaks = beta.pdf((a - 1) / (a + b - 2), a, b)
+            drawn = beta.pdf(x, a[:, None], b[:, None]).max(axis=1)
+            assert (drawn > 0.99 * peaks).all()
+
     def test_get_csv(self):
         response = self.app.test_client().get("/csv")
         assert response.status_code == 200
@@ -164,6 +224,13 @@ class TestApi(TestSetup):
         }
         db.session.add(User(name="Test", api_key="valid_key"))
         db.session.commit()
+        user_ids.clear()
+        results.clear()
+
+    def tearDown(self):
+        """Discard activity buffered by the test before removing its database."""
+        activity.clear()
+        super(TestApi, self).tearDown()
 
     def test_ads_400(self):
         response = self.app.test_client().post("/api/v1/ads", json={})
@@ -185,3 +252,669 @@ class TestApi(TestSetup):
         assert response.status_code == 200
         assert b"ad_id" in response.data
         assert b"ad_share" in response.data
+
+    def test_ads_cache(self):
+        client = self.app.test_client()
+        headers = {"API_KEY": "valid_key"}
+        self.payload["stats"].append(dict(self.payload["stats"][0], ad_id="5678"))
+        first = client.post("/api/v1/ads", json=self.payload, headers=headers)
+        assert first.headers["X-Cache"] == "MISS"
+
+        # Same stats with differently ordered keys and metrics hit the cache
+        payload = {
+            "stats": [dict(reversed(stats.items())) for stats in self.payload["stats"]],
+            "optimize": list(reversed(self.payload["optimize"])),
+        }
+        second = client.post("/api/v1/ads", json=payload, headers=headers)
+        assert second.headers["X-Cache"] == "HIT"
+        assert second.json == first.json
+
+        # Seeded sampling computes the same shares again
+        results.clear()
+        third = client.post("/api/v1/ads", json=self.payload, headers=headers)
+        assert third.headers["X-Cache"] == "MISS"
+        assert third.json == first.json
+
+        response = client.get("/api/v1/ads/cache", headers=headers)
+        assert response.json == {"size": 1, "maxsize": 256, "hits": 0, "misses": 1}
+
+    def test_metrics(self):
+        client = self.app.test_client()
+        response = client.post(
+            "/api/v1/ads", json=self.payload, headers={"API_KEY": "valid_key"}
+        )
+        stages = [
+            timing.split(";")[0]
+            for timing in response.headers["Server-Timing"].split(", ")
+        ]
+        assert stages == [
+            "validate",
+            "cache",
+            "parse",
+            "prepare",
+            "add_daily_results",
+            "calculate_shares",
+            "serialize",
+            "total",
+        ]
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert 'stage_seconds_count{stage="calculate_shares"}' in response.text
+        assert (
+            'request_seconds_bucket{endpoint="api.ads_ads",le="+Inf"}' in response.text
+        )
+        assert 'cache_misses_total{cache="ads_results"} 1' in response.text
+
+    def test_auth_activity(self):
+        self.app.test_client().post(
+            "/api/v1/ads", json=self.payload, headers={"API_KEY": "valid_key"}
+        )
+        user = User.query.one()
+        assert user_ids.get("valid_key") == user.id
+        # Last activity is buffered and written in bulk
+        assert user.last_activity_at is None
+        flush_activity(self.app)
+        db.session.refresh(user)
+        assert user.last_activity_at is not None
+
+    def test_auth_activity_flush(self):
+        # Buffer is flushed in background once the interval has passed
+        with mock.patch("app.api.ACTIVITY_FLUSH_INTERVAL", 0):
+            self.app.test_client().post(
+                "/api/v1/ads", json=self.payload, headers={"API_KEY": "valid_key"}
+            )
+        user = User.query.one()
+        for _ in range(100):
+            db.session.refresh(user)
+            if user.last_activity_at is not None:
+                break
+            time.sleep(0.01)
+        assert user.last_activity_at is not None
+
+        # Activity buffered after the last flush is written at exit
+        flushed = user.last_activity_at
+        self.app.test_client().post(
+            "/api/v1/ads", json=self.payload, headers={"API_KEY": "valid_key"}
+        )
+        flush_remaining_activity()
+        db.session.refresh(user)
+        assert user.last_activity_at > flushed
+
+    def test_ads_binary(self):
+        stats = self.payload["stats"][0]
+        buffer = io.BytesIO()
+        np.savez(buffer, **{key: np.array([value]) for key, value in stats.items()})
+        response = self.app.test_client().post(
+            "/api/v1/ads?optimize=clicks,engagements,conversions",
+            data=buffer.getvalue(),
+            content_type="application/x-npz",
+            headers={"API_KEY": "valid_key"},
+        )
+        assert response.status_code == 200
+        assert response.json == [{"channel": None, "ad_id": "1234", "ad_share": 1.0}]
+
+        response = self.app.test_client().post(
+            "/api/v1/ads?optimize=clicks",
+            data=b"stats",
+            content_type="text/plain",
+            headers={"API_KEY": "valid_key"},
+        )
+        assert response.status_code == 415
+
+        # Readable bodies with invalid values are bad requests
+        for invalid in [
+            {"date": np.array(["01/02/2024"])},
+            {"cost": np.array(["abc"])},
+            {"cost": np.array([1000, 500])},
+        ]:
+            buffer = io.BytesIO()
+            columns = {key: np.array([value]) for key, value in stats.items()}
+            np.savez(buffer, **dict(columns, **invalid))
+            response = self.app.test_client().post(
+                "/api/v1/ads?optimize=clicks",
+                data=buffer.getvalue(),
+                content_type="application/x-npz",
+                headers={"API_KEY": "valid_key"},
+            )
+            assert response.status_code == 400
+
+    def test_ads_columnar(self):
+        client = self.app.test_client()
+        self.payload["stats"].append(dict(self.payload["stats"][0], ad_id="5678"))
+        records = client.post(
+            "/api/v1/ads", json=self.payload, headers={"API_KEY": "valid_key"}
+        ).json
+
+        response = client.post(
+            "/api/v1/ads",
+            json=self.payload,
+            headers={"API_KEY": "valid_key", "Accept": "application/x-columns+json"},
+        )
+        assert response.mimetype == "application/x-columns+json"
+        assert response.json == {
+            key: [record[key] for record in records]
+            for key in ["channel", "ad_id", "ad_share"]
+        }
+
+        response = client.post(
+            "/api/v1/ads",
+            json=self.payload,
+            headers={"API_KEY": "valid_key", "Accept": "application/x-npz"},
+        )
+        assert response.mimetype == "application/x-npz"
+        with np.load(io.BytesIO(response.data), allow_pickle=False) as arrays:
+            assert arrays["ad_id"].tolist() == ["1234", "5678"]
+            assert arrays["channel"].tolist() == ["", ""]
+            assert arrays["ad_share"].tolist() == [
+                record["ad_share"] for record in records
+            ]
+
+    def test_ads_stream(self):
+        stats = self.payload["stats"][0]
+        lines = [stats, dict(stats, cost=500), dict(stats, cost=0), {"cost": 10}]
+        body = "\n".join(json.dumps(line) for line in lines).encode()
+        response = self.app.test_client().post(
+            "/api/v1/ads/stream?optimize=clicks",
+            data=gzip.compress(body),
+            content_type="application/x-ndjson",
+            headers={"API_KEY": "valid_key", "Content-Encoding": "gzip"},
+        )
+        assert response.status_code == 200
+        assert response.json == [{"channel": None, "ad_id": "1234", "ad_share": 1.0}]
+
+        response = self.app.test_client().post(
+            "/api/v1/ads/stream?optimize=clicks",
+            data=body + b"\n{",
+            content_type="application/x-ndjson",
+            headers={"API_KEY": "valid_key"},
+        )
+        assert response.status_code == 400
+
+    def test_ads_batch_200(self):
+        payload = {
+            "optimize": self.payload["optimize"],
+            "campaigns": [
+                {"campaign_id": "a", "stats": self.payload["stats"]},
+                {"campaign_id": "b", "stats": self.payload["stats"] * 2},
+            ],
+        }
+        response = self.app.test_client().post(
+            "/api/v1/ads/batch", json=payload, headers={"API_KEY": "valid_key"}
+        )
+        assert response.status_code == 200
+        assert response.json["a"][0]["ad_id"] == "1234"
+        assert response.json["b"][0]["ad_share"] == 1.0
+
+        # Results are keyed by campaign id, which must be unique
+        payload["campaigns"][1]["campaign_id"] = "a"
+        response = self.app.test_client().post(
+            "/api/v1/ads/batch", json=payload, headers={"API_KEY": "valid_key"}
+        )
+        assert response.status_code == 400
+
+        # Invalid dates are reported with their campaign
+        payload["campaigns"][1] = {
+            "campaign_id": "b",
+            "stats": [dict(self.payload["stats"][0], date="2024-13-45")],
+        }
+        response = self.app.test_client().post(
+            "/api/v1/ads/batch", json=payload, headers={"API_KEY": "valid_key"}
+        )
+        assert response.status_code == 400
+        assert "campaign b" in response.json["message"]
+
+    def test_campaign_state(self):
+        client = self.app.test_client()
+        headers = {"API_KEY": "valid_key"}
+        response = client.post(
+            "/api/v1/ads/campaigns/summer", json=self.payload, headers=headers
+        )
+        assert response.status_code == 200
+        assert response.json[0]["ad_share"] == 1.0
+
+        # Post only the newest day for another ad
+        stats = dict(self.payload["stats"][0], ad_id="5678")
+        stats["date"] = str(datetime.date.today())
+        response = client.post(
+            "/api/v1/ads/campaigns/summer",
+            json={"optimize": self.payload["optimize"], "stats": [stats]},
+            headers=headers,
+        )
+        assert response.status_code == 200
+        assert [ad["ad_id"] for ad in response.json] == ["1234", "5678"]
+
+        state = CampaignState.query.one()
+        assert state.date == datetime.date.today()
+        assert state.trials[1] > state.trials[0]
+        assert abs(state.trials[0] / state.trials[1] - 0.5 ** (1 / 7)) < 1e-9
+
+        # Posting the latest day again replaces its results instead of adding
+        trials = list(state.trials)
+        for cost in [1000, 3000]:
+            response = client.post(
+                "/api/v1/ads/campaigns/summer",
+                json={
+                    "optimize": self.payload["optimize"],
+                    "stats": [dict(stats, cost=cost)],
+                },
+                headers=headers,
+            )
+            assert response.status_code == 200
+        db.session.refresh(state)
+        assert state.trials[0] == trials[0]
+        # Cost 3000 plus inferred successes (3 x 3000) plus 1 row
+        assert trials[1] == 4001 and state.trials[1] == 12001
+
+        # Same day posts of different ads keep each other's results
+        client.post(
+            "/api/v1/ads/campaigns/summer",
+            json={"optimize": self.payload["optimize"], "stats": [stats]},
+            headers=headers,
+        )
+        other = dict(stats, ad_id="1234")
+        client.post(
+            "/api/v1/ads/campaigns/summer",
+            json={"optimize": self.payload["optimize"], "stats": [other]},
+            headers=headers,
+        )
+        db.session.refresh(state)
+        assert state.latest_trials == [4001.0, 4001.0]
+        assert state.trials[1] == 4001.0
+        assert abs(state.trials[0] - trials[0] - 4001.0) < 1e-6
+
+        # Days before the latest day are reported as skipped
+        response = client.post(
+            "/api/v1/ads/campaigns/summer", json=self.payload, headers=headers
+        )
+        assert response.headers["X-Skipped-Dates"] == self.payload["stats"][0]["date"]
+
+        # Invalid dates are rejected
+        response = client.post(
+            "/api/v1/ads/campaigns/summer",
+            json={
+                "optimize": self.payload["optimize"],
+                "stats": [dict(stats, date="2024-13-45")],
+            },
+            headers=headers,
+        )
+        assert response.status_code == 400
+
+
+class TestBandit(unittest.TestCase):
+    """Test bandit optimization model."""
+
+    def setUp(self):
+        self.bandit = ban.Bandit(num_options=3, memory=False)
+        self.bandit.add_results(option_id=0, trials=1000, successes=100)
+        self.bandit.add_results(option_id=1, trials=1000, successes=50)
+        self.bandit.add_results(option_id=2, trials=1000, successes=10)
+
+    def test_draw_samples(self):
+        samples = self.bandit.draw_samples(repetitions=5)
+        assert samples.shape == (5, 3)
+        assert ((samples > 0) & (samples < 1)).all()
+
+    def test_top_options(self):
+        samples = np.random.default_rng(0).random(size=(20, 6))
+        for choices in [1, 3, 6]:
+            top = ban.top_options(samples, choices)
+            assert top.shape == (20, choices)
+            expected = np.argsort(-samples, axis=1)[:, :choices]
+            assert (np.sort(top, axis=1) == np.sort(expected, axis=1)).all()
+
+    def test_choose_options(self):
+        options = self.bandit.choose_options(choices=2)
+        assert len(options) == 2
+        assert 0 in options
+
+    def test_calculate_shares(self):
+        for accelerate in [True, False]:
+            shares = self.bandit.calculate_shares(accelerate=accelerate)
+            assert shares.shape == (3,)
+            assert abs(shares.sum() - 1) < 1e-9
+            assert shares.argmax() == 0
+
+    def test_weigh_options(self):
+        bandit = ban.Bandit(num_options=2, memory=True, cutoff=4, cut_level=0.5)
+        for trials in [100, 200, 300, 400]:
+            bandit.add_period()
+            bandit.add_results(option_id=0, trials=trials, successes=10)
+        trial_weights, success_weights = bandit.weigh_options()
+        # Periods at distance 1, 2 and 3 weigh 0.875, 0.75 and 0.625
+        assert trial_weights[0] == 400 * 0.875 + 300 * 0.75 + 200 * 0.625
+        assert success_weights[0] == 10 * (0.875 + 0.75 + 0.625)
+        assert trial_weights[1] == 0
+
+    def test_period_ring_buffer(self):
+        bandit = ban.Bandit(num_options=2, memory=True, cutoff=4)
+        for period in range(10):
+            bandit.add_period()
+            bandit.add_results(option_id=1, trials=period, successes=0)
+        assert bandit.period_trials.shape == (5, 2)
+        assert [trials[1] for trials in bandit.periods["trials"]] == [5, 6, 7, 8, 9]
+        assert bandit.trials[1] == sum(range(10))
+
+    def test_add_daily_results(self):
+        today = datetime.date.today()
+        data = pd.DataFrame(
+            {
+                "date": [today - datetime.timedelta(days=d) for d in [0, 1, 1, 20]],
+                "option_id": [0, 1, 1, 0],
+                "trials": [100.0, 50.5, 20.0, 1000.0],
+                "successes": [10.0, 5.0, 2.0, 100.0],
+            }
+        )
+        bandit = ban.Bandit(num_options=2, memory=True, cutoff=4)
+        bandit.add_daily_results(data)
+        assert bandit.trials.tolist() == [100, 70]
+        assert bandit.periods["trials"][-1].tolist() == [100, 0]
+        assert bandit.periods["trials"][-2].tolist() == [0, 70]
+
+    def test_calculate_shares_exact(self):
+        shares = self.bandit.calculate_shares(accelerate=True, exact=True)
+        assert abs(shares.sum() - 1) < 1e-9
+        assert shares[0] > 0.99
+        assert (shares == self.bandit.calculate_shares(True, exact=True)).all()
+
+    def test_best_probabilities_mixed_widths(self):
+        # New (wide) option next to mature (narrow) ones
+        bandit = ban.Bandit(num_options=3, memory=False)
+        for option_id, [trials, successes] in enumerate(
+            [[1000000, 100000], [1000000, 100150], [2, 1]]
+        ):
+            bandit.add_results(option_id, trials, successes)
+        probabilities = bandit.best_probabilities()
+        samples = np.random.default_rng(0).beta(
+            1 + bandit.successes,
+            1 + bandit.trials - bandit.successes,
+            size=(200000, 3),
+        )
+        estimates = np.bincount(samples.argmax(axis=1), minlength=3) / 200000
+        assert np.abs(probabilities - estimates).max() < 0.002
+
+    def test_best_probabilities_many_options(self):
+        # Grid stays bounded with hundreds of options of similar rates
+        rng = np.random.default_rng(1)
+        trials = rng.integers(100, 5000, size=300)
+        successes = (trials * rng.uniform(0.08, 0.12, size=300)).astype(int)
+        a = 1.0 + successes
+        b = 1.0 + trials - successes
+        grid = ban.integration_grid(a, b, 0.0, 1.0, max_points=1024)
+        assert len(grid) <= 2 * 1024 + 2
+        assert (np.diff(grid) > 0).all()
+
+        bandit = ban.Bandit(num_options=300, memory=False)
+        for option_id in range(300):
+            bandit.add_results(option_id, trials[option_id], successes[option_id])
+        start = datetime.datetime.now()
+        probabilities = bandit.best_probabilities()
+        assert datetime.datetime.now() - start < datetime.timedelta(seconds=10)
+        assert abs(probabilities.sum() - 1) < 1e-9
+
+    def test_calculate_shares_precision(self):
+        shares = self.bandit.calculate_shares(False, precision=0.02, seed=42)
+        assert abs(shares.sum() - 1) < 1e-9
+        assert 0 < self.bandit.repetitions <= 10000
+        repeated = self.bandit.calculate_shares(False, precision=0.02, seed=42)
+        assert (shares == repeated).all()
+
+    def test_batch_calculate_shares(self):
+        bandits = [self.bandit, ban.Bandit(num_options=1, memory=False)]
+        for accelerate in [True, False]:
+            shares = bat.calculate_shares(bandits, accelerate=accelerate)
+            assert [len(option_shares) for option_shares in shares] == [3, 1]
+            assert abs(shares[0].sum() - 1) < 1e-9
+            assert shares[1][0] == 1.0
+
+    def test_batch_calculate_shares_widths(self):
+        # Campaigns of equal width are sampled together, in request order
+        bandits = []
+        for num_options, best in [(3, 0), (25, 1), (3, 2), (25, 0)]:
+            bandit = ban.Bandit(num_options=num_options, memory=False)
+            bandit.add_results(best, 10000, 9999)
+            bandits.append(bandit)
+        shares = bat.calculate_shares(bandits, accelerate=False)
+        assert [len(option_shares) for option_shares in shares] == [3, 25, 3, 25]
+        assert [option_shares.argmax() for option_shares in shares] == [0, 1, 2, 0]
+        for option_shares, bandit in zip(shares, bandits):
+            choices = ban.sampling_plan(bandit.num_options, accelerate=True)[0]
+            assert abs(option_shares.sum() - 1) < 1e-9
+            assert choices == (1 if bandit.num_options == 3 else 3)
+
+    def test_exponential_shape(self):
+        bandit = ban.Bandit(num_options=2, memory=True, shape="exponential", cutoff=4)
+        assert bandit.half_life == 4
+        for period in range(100):
+            bandit.add_period()
+            bandit.add_results(option_id=0, trials=100, successes=10)
+        trial_weights, success_weights = bandit.weigh_options()
+        # Geometric series of the per period decay factor
+        assert abs(trial_weights[0] - 100 / (1 - 0.5 ** (1 / 4))) < 1e-3
+        assert success_weights[1] == 0
+        assert not hasattr(bandit, "period_trials")
+        with self.assertRaises(ValueError):
+            bandit.periods
+
+        # Cut level 1 means no decay
+        bandit = ban.Bandit(
+            num_options=1, memory=True, shape="exponential", cut_level=1.0
+        )
+        bandit.add_period()
+        bandit.add_results(option_id=0, trials=100, successes=10)
+        bandit.add_period()
+        assert bandit.weigh_options()[0].tolist() == [100.0]
+
+        # Default half-life needs a cut level that decays to a finite half-life
+        for cut_level in [0, -0.5, 1.5]:
+            with self.assertRaises(ValueError):
+                ban.Bandit(num_options=1, shape="exponential", cut_level=cut_level)
+        bandit = ban.Bandit(
+            num_options=1, shape="exponential", cut_level=0, half_life=7
+        )
+        assert bandit.half_life == 7
+
+
+class TestProcess(unittest.TestCase):
+    """Test data pre-processing."""
+
+    def test_preprocess(self):
+        data = pd.DataFrame(
+            {
+                "Day": ["2021-01-01", "2021-01-01", "2021-01-02"],
+                "Ad ID": [1, 2, 1],
+                "Cost": [100, 0, 50.5],
+                "Impressions": [1000, 10, 500],
+                "Clicks": [10, 1, ""],
+                "Currency": ["EUR", "EUR", "EUR"],
+            }
+        )
+        data = pro.preprocess(data, impression_weight=0, click_weight=None)
+        assert list(data.columns) == ["date", "ad_id", "successes", "trials"]
+        # Click weight is total cost per click
+        assert data["successes"].tolist() == [150.5, 0.0]
+        assert data["trials"].tolist() == [251.5, 51.0]
+
+    def test_reindex_options(self):
+        data = pd.DataFrame(
+            {
+                "channel": ["facebook", "instagram", "facebook", "instagram"],
+                "date": ["2021-01-01", "2021-01-01", "2021-01-02", "2021-01-02"],
+                "ad_id": [1, 1, 2, 1],
+                "successes": [1.0, 2.0, 3.0, 4.0],
+                "trials": [10.0, 20.0, 30.0, 40.0],
+            },
+            index=[3, 5, 7, 9],
+        )
+        [options, data] = pro.reindex_options(data)
+        assert options.to_dict("records") == [
+            {"channel": "facebook", "ad_id": 1},
+            {"channel": "instagram", "ad_id": 1},
+            {"channel": "facebook", "ad_id": 2},
+        ]
+        assert data["option_id"].tolist() == [0, 1, 2, 1]
+
+    def test_prepare_columns(self):
+        today = datetime.date.today()
+        records = [
+            {"date": str(today), "ad_id": "1", "cost": 100, "clicks": 10},
+            {"date": str(today), "ad_id": "2", "cost": 0, "clicks": 5},
+            {"date": str(today - datetime.timedelta(days=20)), "ad_id": "3", "cost": 1},
+            {"date": str(today - datetime.timedelta(days=1)), "ad_id": "1", "cost": 50},
+        ]
+        [options, option_ids, days_ago, trials, successes] = col.prepare(
+            col.records_to_columns(records), cutoff=14, impression_weight=0
+        )
+        assert options == [{"ad_id": "1"}]
+        assert option_ids.tolist() == [0, 0]
+        assert days_ago.tolist() == [0, 1]
+        # Click weight is total cost (including old rows) per click
+        assert successes.tolist() == [151.0, 0.0]
+        assert trials.tolist() == [252.0, 51.0]
+
+    def test_fold_records(self):
+        today = datetime.date.today()
+        records = [
+            {
+                "channel": channel,
+                "date": str(today - datetime.timedelta(days=day)),
+                "ad_id": ad_id,
+                "cost": cost,
+                "impressions": 100,
+                "clicks": cost // 10,
+            }
+            for day in range(3)
+            for channel, ad_id, cost in [
+                ("facebook", "1", 50),
+                ("google", "1", 70),
+                ("facebook", "1", 30),
+                ("facebook", None, 40),
+                ("google", "2", 0),
+            ]
+        ]
+        columns = col.fold_records(records)
+        assert columns["ad_id"] == ["1", "1"] * 3
+        assert columns["rows"].tolist() == [2.0, 1.0] * 3
+
+        # Summed records prepare to the same per option results
+        folded = col.prepare(columns, cutoff=14)
+        expected = col.prepare(col.records_to_columns(records), cutoff=14)
+        assert folded[0] == expected[0]
+        for values in [1, 2, 3, 4]:
+            assert np.allclose(folded[values], expected[values])
+
+    def test_read_csv(self):
+        text = "Day;Ad ID;Cost;Clicks;Currency\n2021-01-01;1;100;10;EUR\n"
+        text += "2021-01-01;1;50;;EUR\n"
+        data = pro.read_csv(text)
+        # Google export profile renames columns and skips dropped ones
+        assert list(data.columns) == ["date", "ad_id", "cost", "clicks"]
+        assert data["ad_id"].dtype == "category"
+        assert data["clicks"].dtype == "float32"
+        assert len(data) == 2
+        # Chunks are aggregated per option and date
+        data = pro.read_csv(text + "2021-01-02;1;0;0;EUR\n2021-01-02;2;10;1;EUR\n", 2)
+        assert data.astype({"ad_id": str}).to_dict("records") == [
+            {
+                "date": "2021-01-01",
+                "ad_id": "1",
+                "cost": 150,
+                "clicks": 10,
+                "truncated_cost": 150,
+                "rows": 2,
+            },
+            {
+                "date": "2021-01-02",
+                "ad_id": "2",
+                "cost": 10,
+                "clicks": 1,
+                "truncated_cost": 10,
+                "rows": 1,
+            },
+        ]
+        data = pro.preprocess(data, click_weight=1)
+        assert data["trials"].tolist() == [162.0, 12.0]
+
+    def test_read_csv_descriptive(self):
+        # Facebook export options are described by ad name and id
+        text = "Ad name,Ad ID,Reporting starts,Reporting ends,Amount spent (EUR),"
+        text += "Link clicks\nSummer,1,2021-01-01,2021-01-01,100,10\n"
+        text += "Winter,2,2021-01-01,2021-01-01,50,5\n"
+        data = pro.read_csv(text)
+        assert list(data.columns) == ["ad_name", "ad_id", "date", "cost", "clicks"]
+        assert data["ad_name"].dtype == "category"
+        data = pro.preprocess(pro.read_csv(text, chunksize=1), click_weight=1)
+        [options, data] = pro.reindex_options(data)
+        assert options.astype({"ad_id": str}).to_dict("records") == [
+            {"ad_name": "Summer", "ad_id": "1"},
+            {"ad_name": "Winter", "ad_id": "2"},
+        ]
+
+    def test_read_csv_placeholders(self):
+        # Google exports use "--" for empty metrics
+        text = "Day,Ad ID,Cost,Clicks,Conversions\n2021-01-01,1,100,10,--\n"
+        data = pro.read_csv(text)
+        assert data["conversions"].dtype == "float32"
+        assert data["conversions"].isna().all()
+        assert data["clicks"].tolist() == [10.0]
+
+    def test_read_csv_chunk_invariance(self):
+        # Hourly rows with fractional costs
+        text = "Day;Ad ID;Cost;Clicks\n" + "2021-01-01;1;1.57;1\n" * 24
+        trials = [
+            pro.preprocess(pro.read_csv(text, chunksize), click_weight=1)["trials"]
+            for chunksize in [100, 5]
+        ]
+        assert trials[0].tolist() == trials[1].tolist() == [72.0]
+
+    def test_preprocess_collapse(self):
+        data = pd.DataFrame(
+            {
+                "date": ["2021-01-01"] * 3 + ["2021-01-02"],
+                "ad_id": [1, 1, 2, 1],
+                "cost": [100, 200, 50, 10],
+                "clicks": [10, 20, 5, 1],
+            }
+        )
+        data = pro.preprocess(data, click_weight=1)
+        assert data.to_dict("records") == [
+            {
+                "date": "2021-01-01",
+                "ad_id": 1,
+                "successes": 30.0,
+                "trials": 332.0,
+            },
+            {
+                "date": "2021-01-01",
+                "ad_id": 2,
+                "successes": 5.0,
+                "trials": 56.0,
+            },
+            {
+                "date": "2021-01-02",
+                "ad_id": 1,
+                "successes": 1.0,
+                "trials": 12.0,
+            },
+        ]
+
+    def test_fractional_successes(self):
+        # Hourly rows with fractional successes are truncated after summing
+        # them per option and date, in CSV and JSON stats alike
+        today = str(datetime.date.today())
+        text = "Day;Ad ID;Cost;Clicks\n" + f"{today};1;1;0.9\n" * 24
+        data = pro.preprocess(pro.read_csv(text), click_weight=1)
+        data = pro.filter_dates(data, cutoff=14)
+        [options, data] = pro.reindex_options(data)
+        from_csv = ban.Bandit(num_options=len(options), cutoff=14)
+        from_csv.add_daily_results(data)
+
+        records = [{"date": today, "ad_id": "1", "cost": 1, "clicks": 0.9}] * 24
+        [options, *arrays] = col.prepare(
+            col.records_to_columns(records), cutoff=14, click_weight=1
+        )
+        from_json = ban.Bandit(num_options=len(options), cutoff=14)
+        from_json.add_daily_arrays(*arrays)
+
+        assert from_csv.successes.tolist() == from_json.successes.tolist() == [21]
+        assert from_csv.trials.tolist() == from_json.trials.tolist() == [69]